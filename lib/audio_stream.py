@@ -0,0 +1,106 @@
+import math
+from typing import BinaryIO, Iterable, Iterator
+
+import numpy as np
+import soundfile as sf
+import soxr
+
+
+# Resamples consecutive blocks of a mono signal, keeping the filter state between blocks so the
+# output is the same as resampling the whole signal at once.
+class StreamingResampler:
+    def __init__(self, in_rate: int, out_rate: int):
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        self.stream = None if in_rate == out_rate else soxr.ResampleStream(in_rate, out_rate, 1, dtype="float32")
+
+    # Pass last=True with the final block to flush the samples still held by the filter.
+    def process(self, block: np.ndarray, last: bool = False) -> np.ndarray:
+        block = np.ascontiguousarray(block, dtype=np.float32)
+        if self.stream is None:
+            return block
+        return self.stream.resample_chunk(block, last=last)
+
+
+def to_mono(block: np.ndarray) -> np.ndarray:
+    if block.ndim == 1:
+        return block
+    return block.mean(axis=1, dtype=np.float32)
+
+
+# Decodes an audio file (path or seekable file object, any format soundfile reads: WAV, FLAC, OGG, ...)
+# block by block into mono float32 at sample_rate. Only one block is held in memory at a time.
+def decode_blocks(file: str | BinaryIO, sample_rate: int, block_size: int = 1 << 16) -> Iterator[np.ndarray]:
+    with sf.SoundFile(file) as audio:
+        resampler = StreamingResampler(audio.samplerate, sample_rate)
+        for block in audio.blocks(blocksize=block_size, dtype="float32", always_2d=True):
+            yield resampler.process(to_mono(block))
+        yield resampler.process(np.zeros(0, dtype=np.float32), last=True)
+
+
+# Decodes a whole audio file into mono float32 at sample_rate, with the same samples as decode_blocks and
+# librosa.load. Audio already at sample_rate is returned as decoded, without going through the resampler.
+def read_audio(file: str | BinaryIO, sample_rate: int) -> np.ndarray:
+    signal, rate = sf.read(file, dtype="float32", always_2d=True)
+    signal = to_mono(signal)
+    if rate == sample_rate:
+        return np.ascontiguousarray(signal)
+    resampled = soxr.resample(signal, rate, sample_rate, quality="HQ")
+    return np.concatenate(list(fit_length([resampled], math.ceil(len(signal) * sample_rate / rate))))
+
+
+# Number of samples decode_blocks yields for a file, from its header without decoding it (the length
+# librosa.load gives when resampling).
+def decoded_length(file: str | BinaryIO, sample_rate: int) -> int:
+    info = sf.info(file)
+    return math.ceil(info.frames * sample_rate / info.samplerate)
+
+
+# Truncates or zero pads a stream of blocks to exactly `length` samples.
+def fit_length(blocks: Iterable[np.ndarray], length: int) -> Iterator[np.ndarray]:
+    remaining = length
+    for block in blocks:
+        if remaining <= 0:
+            break
+        block = block[:remaining]
+        remaining -= len(block)
+        yield block
+    if remaining > 0:
+        yield np.zeros(remaining, dtype=np.float32)
+
+
+# Cuts a stream of blocks into segments of `windows_per_segment` overlapping windows (the last one may hold
+# fewer): segment k holds the samples of windows [k * windows_per_segment, (k + 1) * windows_per_segment),
+# so consecutive segments overlap by window_length - step_length samples. Only windows that fit entirely
+# are produced, like Tensor.unfold. At most a segment and a block are held in memory.
+def window_segments(blocks: Iterable[np.ndarray], window_length: int, step_length: int, windows_per_segment: int) -> Iterator[np.ndarray]:
+    segment_length = (windows_per_segment - 1) * step_length + window_length
+    advance = windows_per_segment * step_length
+    buffer = np.zeros(0, dtype=np.float32)
+    for block in blocks:
+        buffer = np.concatenate([buffer, block])
+        while len(buffer) >= segment_length:
+            yield buffer[:segment_length].copy()
+            buffer = buffer[advance:]
+    if len(buffer) >= window_length:
+        windows = (len(buffer) - window_length) // step_length + 1
+        yield buffer[:(windows - 1) * step_length + window_length].copy()
+
+
+# Yields the samples of a stream of blocks that fall in the sorted, non overlapping [start, end) sample ranges.
+def cut_ranges(blocks: Iterable[np.ndarray], ranges: list[tuple[int, int]]) -> Iterator[np.ndarray]:
+    ranges = iter(ranges)
+    current = next(ranges, None)
+    offset = 0
+    for block in blocks:
+        block_end = offset + len(block)
+        while current is not None and current[0] < block_end:
+            start, end = max(current[0], offset), min(current[1], block_end)
+            if start < end:
+                yield block[start - offset:end - offset]
+            if current[1] > block_end:
+                break
+            current = next(ranges, None)
+        if current is None:
+            return
+        offset = block_end
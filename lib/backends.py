@@ -0,0 +1,204 @@
+import argparse
+import json
+import logging
+import os
+import time
+from typing import Callable
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from lib.config import Config
+from lib.precision import (BF16_PARITY_TOLERANCE, PRECISIONS,
+                           BFloat16Backbone, resolve_precision)
+
+logger = logging.getLogger(__name__)
+
+# Values of INFERENCE_BACKEND.
+BACKENDS = ("eager", "torchscript", "compile", "onnx")
+
+# Max absolute difference in backbone logits accepted before a backend falls back to eager.
+PARITY_TOLERANCE = 1e-3
+
+
+def backbone_example(model: nn.Module, batch_size: int = 1) -> torch.Tensor:
+    """Random backbone input (B, 1, image_size, image_size) of the MED / MSC model."""
+    return torch.rand(batch_size, 1, model.image_size, model.image_size, device=next(model.backbone.parameters()).device)
+
+
+def onnx_path(checkpoint_path: str) -> str:
+    """Where the ONNX backbone of a checkpoint is exported to and loaded from, next to the checkpoint."""
+    return f"{os.path.splitext(checkpoint_path)[0]}.backbone.onnx"
+
+
+def export_onnx(model: nn.Module, path: str, opset: int = 17) -> str:
+    """Exports the backbone of a loaded model with a dynamic batch axis.
+
+    Only the backbone is exported, the STFT frontend (complex FFTs, chirp-z) has no ONNX equivalent in
+    torch 2.1 and stays in torch."""
+    model.eval()
+    with torch.no_grad():
+        torch.onnx.export(model.backbone, backbone_example(model), path,
+                          input_names=["input"], output_names=["logits"],
+                          dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+                          opset_version=opset)
+    logger.info("Exported backbone to {0}".format(path))
+    return path
+
+
+class OnnxBackbone:
+    """Runs an exported backbone with ONNX Runtime on the CPU, called like the backbone module."""
+
+    def __init__(self, path: str, threads: int | None = None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads or torch.get_num_threads()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.path = path
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        logits, = self.session.run(None, {"input": x.detach().cpu().numpy().astype(np.float32, copy=False)})
+        return torch.from_numpy(logits).to(x.device)
+
+
+def build_backbone_runner(model: nn.Module, backend: str, checkpoint_path: str) -> Callable[[torch.Tensor], torch.Tensor]:
+    backbone = model.backbone
+    match backend:
+        case "eager":
+            return backbone
+        case "torchscript":
+            with torch.no_grad():
+                return torch.jit.freeze(torch.jit.trace(backbone, backbone_example(model)))
+        case "compile":
+            return torch.compile(backbone, dynamic=True)
+        case "onnx":
+            path = onnx_path(checkpoint_path)
+            if not os.path.exists(path):
+                export_onnx(model, path)
+            return OnnxBackbone(path)
+    raise ValueError("Unknown inference backend {0}, expected one of {1}".format(backend, ", ".join(BACKENDS)))
+
+
+def latency_per_window(runner: Callable[[torch.Tensor], torch.Tensor], example: torch.Tensor, runs: int = 3) -> float:
+    """Mean milliseconds per window of `runs` calls on the example batch, after one warm-up call."""
+    with torch.no_grad():
+        runner(example)
+        start = time.perf_counter()
+        for _ in range(runs):
+            runner(example)
+    return (time.perf_counter() - start) * 1000 / (runs * example.shape[0])
+
+
+def apply_backend(model: nn.Module, backend: str, checkpoint_path: str, batch_size: int = 1, precision: str = "fp32") -> dict:
+    """Runs the backbone of a loaded, eval mode MED / MSC model with `backend` in `precision`.
+
+    bf16 runs the backbone in channels_last under CPU autocast (lib/precision.py) and falls back to fp32
+    where it is not supported. The backend is checked against the eager fp32 backbone on a random batch: a
+    backend that cannot be built (e.g. onnxruntime or a C++ compiler missing) or whose logits differ by more
+    than PARITY_TOLERANCE (BF16_PARITY_TOLERANCE in bf16) is replaced by eager fp32. The eager module stays
+    the model's `backbone`, so state dicts are unaffected; the process pool runs it (process_pool_fallback).
+    Returns the report: requested and used backend and precision and, unless eager fp32 is used, the parity
+    and latency per window of both."""
+    report = {"requested": backend, "backend": "eager", "requested_precision": precision, "precision": "fp32"}
+    precision, reason = resolve_precision(precision, model, backend)
+    if reason is not None:
+        report["precision_fallback"] = reason
+        logger.warning("Running the backbone in fp32 instead of {0}: {1}".format(report["requested_precision"], reason))
+    if backend == "eager" and precision == "fp32":
+        return report
+
+    example = backbone_example(model, batch_size)
+    try:
+        with torch.no_grad():
+            expected = model.backbone(example)
+        if precision == "bf16":
+            model.backbone.to(memory_format=torch.channels_last)
+        runner = build_backbone_runner(model, backend, checkpoint_path)
+        if precision == "bf16":
+            runner = BFloat16Backbone(runner)
+        with torch.no_grad():
+            max_abs_diff = (runner(example) - expected).abs().max().item()
+        report["max_abs_diff"] = max_abs_diff
+        if max_abs_diff <= (BF16_PARITY_TOLERANCE if precision == "bf16" else PARITY_TOLERANCE):
+            model.set_backbone_runner(runner)
+            report["backend"] = backend
+            report["precision"] = precision
+        else:
+            report["error"] = "logits differ by {0:.2e}".format(max_abs_diff)
+    except Exception as e:
+        report["error"] = "{0}: {1}".format(type(e).__name__, e)
+
+    report["eager_ms_per_window"] = latency_per_window(model.backbone, example)
+    if model.backbone_runner is not None:
+        report["ms_per_window"] = latency_per_window(model.run_backbone, example)
+    if "error" in report:
+        logger.warning("Inference backend {0} in {1} not used, falling back to eager fp32: {2}".format(backend, precision, report["error"]))
+    return report
+
+
+def process_pool_fallback(model: nn.Module, report: dict):
+    """Drops the backend of a model whose forwards move to the process pool (lib/process_pool.py).
+
+    The workers build the eager fp32 backbone, so the model in this process runs it as well and every forward
+    gives the same results; the report records the fallback and says eager fp32 is used."""
+    if report["backend"] == "eager" and report["precision"] == "fp32":
+        return
+    report["process_pool_fallback"] = "process pool workers run the eager fp32 backbone, not {0} in {1}".format(report["backend"], report["precision"])
+    report["backend"] = "eager"
+    report["precision"] = "fp32"
+    model.set_backbone_runner(None)
+    logger.warning("Inference backend not used: {0}".format(report["process_pool_fallback"]))
+
+
+def _load(kind: str, checkpoint_path: str) -> nn.Module:
+    from lib.checkpoints import load_model
+    if kind == "med":
+        from lib.med.mids_med import MidsMEDModel
+        model = load_model(MidsMEDModel, checkpoint_path)
+    else:
+        from lib.msc.mids_msc import MidsMSCModel
+        model = load_model(MidsMSCModel, checkpoint_path)
+    model.eval()
+    model.prepare_for_inference()
+    return model
+
+
+def _parity(kind: str, checkpoint_path: str, backends: list[str], windows: int, precision: str) -> dict:
+    # Whole model forwards on the same random audio windows, the backend against eager
+    model = _load(kind, checkpoint_path)
+    audio = torch.rand(windows, Config.default().single_batch_length()) * 2 - 1
+    with torch.no_grad():
+        expected = torch.softmax(model(audio)["prediction"], dim=1)
+    reports = {}
+    for backend in backends:
+        report = apply_backend(model, backend, checkpoint_path, batch_size=windows, precision=precision)
+        with torch.no_grad():
+            probabilities = torch.softmax(model(audio)["prediction"], dim=1)
+        report["max_abs_probability_diff"] = (probabilities - expected).abs().max().item()
+        reports[backend] = report
+        model.set_backbone_runner(None)
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports the MED / MSC backbones to ONNX and checks the inference backends against eager.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="export the backbone of a checkpoint to <checkpoint>.backbone.onnx")
+    export.add_argument("kind", choices=("med", "msc"))
+    export.add_argument("checkpoint")
+    parity = commands.add_parser("parity", help="compare the probabilities and latency of every backend to eager")
+    parity.add_argument("kind", choices=("med", "msc"))
+    parity.add_argument("checkpoint")
+    parity.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=BACKENDS)
+    parity.add_argument("--windows", type=int, default=4)
+    parity.add_argument("--precision", default="fp32", choices=PRECISIONS)
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if arguments.command == "export":
+        export_onnx(_load(arguments.kind, arguments.checkpoint), onnx_path(arguments.checkpoint))
+    else:
+        print(json.dumps(_parity(arguments.kind, arguments.checkpoint, arguments.backends, arguments.windows, arguments.precision), indent=4))
@@ -0,0 +1,187 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable
+
+import numpy as np
+import torch
+
+# Number of recent batches the latency percentiles are computed over.
+METRICS_HISTORY = 1024
+
+
+class _Request:
+    def __init__(self, windows: torch.Tensor):
+        self.windows = windows
+        self.future: Future = Future()
+        self.submitted = time.perf_counter()
+        # Windows already handed to a batch, and the results of the pieces that have finished, in order
+        self.taken = 0
+        self.pieces: list[torch.Tensor] = []
+        self.pieces_pending = 0
+
+
+class BatchMetrics:
+    def __init__(self, max_batch_size: int):
+        self.max_batch_size = max_batch_size
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.windows = 0
+        self.requests = 0
+        self.fill_rates = deque(maxlen=METRICS_HISTORY)
+        self.wait_ms = deque(maxlen=METRICS_HISTORY)
+        self.forward_ms = deque(maxlen=METRICS_HISTORY)
+
+    def record(self, size: int, requests: int, waits_ms: list[float], forward_ms: float):
+        with self._lock:
+            self.batches += 1
+            self.windows += size
+            self.requests += requests
+            self.fill_rates.append(size / self.max_batch_size)
+            self.wait_ms.extend(waits_ms)
+            self.forward_ms.append(forward_ms)
+
+    def snapshot(self) -> dict:
+        def percentiles(values) -> dict:
+            if not values:
+                return {"mean": 0.0, "p50": 0.0, "p99": 0.0}
+            values = np.fromiter(values, dtype=np.float64)
+            return {"mean": float(values.mean()), "p50": float(np.percentile(values, 50)), "p99": float(np.percentile(values, 99))}
+
+        with self._lock:
+            return {
+                "max_batch_size": self.max_batch_size,
+                "batches": self.batches,
+                "windows": self.windows,
+                "requests": self.requests,
+                "mean_batch_size": self.windows / self.batches if self.batches else 0.0,
+                "fill_rate": float(np.mean(self.fill_rates)) if self.fill_rates else 0.0,
+                "wait_ms": percentiles(self.wait_ms),
+                "forward_ms": percentiles(self.forward_ms),
+            }
+
+
+# Windows as (B, L) rows, so requests shaped (B, L) and (B, 1, L) can share a batch.
+def _rows(windows: torch.Tensor) -> torch.Tensor:
+    return windows.flatten(1) if windows.dim() > 2 else windows
+
+
+"""
+Dynamic micro-batching of model forwards across threads (e.g. one per websocket connection).
+   - predict: the batched forward, (B, ...) windows -> (B, ...) results.
+   - max_batch_size: most windows in a single forward.
+   - max_wait_ms: how long the oldest pending request may wait for others to join its batch.
+Callers block in `predict(windows)` while a single batcher thread concatenates the pending windows of all
+callers, as (B, L) rows, runs one forward and hands every caller its own rows back. Requests are served first
+come first served and their results keep the order of their windows; a request larger than max_batch_size is
+split over consecutive batches, and a failed forward fails the whole of every request it had a piece of. `initializer` runs first on the batcher thread, e.g. to set its torch threads.
+`metrics.snapshot()` reports the batch fill rate and the latency added by waiting. `shutdown()` stops the
+batcher thread once the pending requests are served.
+"""
+class MicroBatcher:
+    def __init__(self, predict: Callable[[torch.Tensor], torch.Tensor], max_batch_size: int, max_wait_ms: float, name: str = "batcher", initializer: Callable[[], None] | None = None):
+        self.logger = logging.getLogger(name)
+        self._predict = predict
+        self._initializer = initializer
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.metrics = BatchMetrics(self.max_batch_size)
+        self._pending: deque[_Request] = deque()
+        self._pending_windows = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def predict(self, windows: torch.Tensor) -> torch.Tensor:
+        if threading.current_thread() is self._thread:
+            return self._predict(_rows(windows))
+        return self.submit(windows).result()
+
+    def submit(self, windows: torch.Tensor) -> Future:
+        windows = _rows(windows)
+        request = _Request(windows)
+        if windows.shape[0] == 0:
+            request.future.set_result(self._predict(windows))
+            return request.future
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The micro-batcher has been shut down.")
+            self._pending.append(request)
+            self._pending_windows += windows.shape[0]
+            self._condition.notify()
+        return request.future
+
+    def _next_batch(self) -> list[tuple[_Request, int, int]]:
+        with self._condition:
+            while not self._pending and not self._closed:
+                self._condition.wait()
+            if not self._pending:
+                return []
+            deadline = self._pending[0].submitted + self.max_wait
+            while self._pending_windows < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            # (request, first window, end window) pieces in submission order
+            batch = []
+            size = 0
+            while self._pending and size < self.max_batch_size:
+                request = self._pending[0]
+                if request.future.done():
+                    # Failed in an earlier batch, or cancelled by its caller
+                    self._pending.popleft()
+                    self._pending_windows -= request.windows.shape[0] - request.taken
+                    continue
+                count = min(request.windows.shape[0] - request.taken, self.max_batch_size - size)
+                batch.append((request, request.taken, request.taken + count))
+                request.taken += count
+                request.pieces_pending += 1
+                size += count
+                if request.taken == request.windows.shape[0]:
+                    self._pending.popleft()
+            self._pending_windows -= size
+            return batch
+
+    def _run(self):
+        if self._initializer is not None:
+            self._initializer()
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            started = time.perf_counter()
+            try:
+                results = self._predict(torch.cat([request.windows[start:end] for request, start, end in batch]))
+            except Exception as e:
+                self.logger.exception("Batched forward failed")
+                with self._condition:
+                    for request, _, _ in batch:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+                        # The rest of a split request is not run
+                        if request.taken < request.windows.shape[0] and request in self._pending:
+                            self._pending.remove(request)
+                            self._pending_windows -= request.windows.shape[0] - request.taken
+                continue
+            forward_ms = (time.perf_counter() - started) * 1000
+
+            offset = 0
+            for request, start, end in batch:
+                request.pieces.append(results[offset:offset + end - start])
+                offset += end - start
+                request.pieces_pending -= 1
+                if request.taken == request.windows.shape[0] and request.pieces_pending == 0 and not request.future.done():
+                    request.future.set_result(request.pieces[0] if len(request.pieces) == 1 else torch.cat(request.pieces))
+
+            waits_ms = [(started - request.submitted) * 1000 for request, start, _ in batch if start == 0]
+            self.metrics.record(offset, len(batch), waits_ms, forward_ms)
+
+    def shutdown(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
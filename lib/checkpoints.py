@@ -0,0 +1,134 @@
+import argparse
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+
+logger = logging.getLogger(__name__)
+
+# Marks a checkpoint written by `convert`.
+INFERENCE_FORMAT = "mids-inference-1"
+
+# Modules of the training checkpoints the inference forward never uses, per model kind.
+UNUSED_MODULES = {"med": (), "msc": ("out",)}
+
+PCEN_PARAMETERS = ("s", "alpha", "delta", "r")
+
+
+# nn.Module.register_parameter is patched while a model is built, one model at a time
+_empty_parameters_lock = threading.Lock()
+
+
+@contextmanager
+def _empty_parameters():
+    # Parameters are created on the meta device, so building the model skips allocating and randomly
+    # initializing weights the checkpoint replaces. Buffers stay real, the nnAudio kernels are built eagerly.
+    # Modules other threads build meanwhile keep real parameters.
+    thread = threading.get_ident()
+    with _empty_parameters_lock:
+        register_parameter = nn.Module.register_parameter
+
+        def register_on_meta(module: nn.Module, name: str, parameter: nn.Parameter | None):
+            register_parameter(module, name, parameter)
+            if parameter is not None and threading.get_ident() == thread:
+                module._parameters[name] = nn.Parameter(parameter.to("meta"), requires_grad=parameter.requires_grad)
+
+        nn.Module.register_parameter = register_on_meta
+        try:
+            yield
+        finally:
+            nn.Module.register_parameter = register_parameter
+
+
+def _read(path: str, device: torch.device) -> dict:
+    try:
+        # Zip checkpoints are memory mapped: nothing is read until used and processes loading the same
+        # file share its pages through the page cache
+        return torch.load(path, map_location="cpu", mmap=True)
+    except RuntimeError:
+        # Legacy (non zip) files cannot be memory mapped
+        return torch.load(path, map_location=device)
+
+
+def load_model(model_class: type, path: str, device: torch.device = torch.device("cpu")) -> nn.Module:
+    """Builds a MidsMEDModel / MidsMSCModel from a training checkpoint or an inference checkpoint (`convert`).
+
+    The model is built without weights and takes the checkpoint's tensors as its parameters (assign=True)
+    instead of copying them into randomly initialized ones. Models loaded from an inference checkpoint
+    keep its path as `inference_checkpoint`."""
+    checkpoint = _read(path, device)
+    with _empty_parameters():
+        model = model_class()
+
+    if checkpoint.get("format") != INFERENCE_FORMAT:
+        model.load_state_dict(checkpoint, assign=True)
+        return model.to(device)
+
+    for name in checkpoint["unused_modules"]:
+        setattr(model, name, None)
+    pcen = model.pcen_layer
+    for name, value in checkpoint["pcen"].items():
+        delattr(pcen, f"log_{name}")
+        setattr(pcen, name, value)
+    pcen.trainable = False
+    # fp16 checkpoints are widened back, the forward runs in fp32
+    state_dict = {key: value.float() if value.dtype == torch.float16 else value for key, value in checkpoint["state_dict"].items()}
+    model.load_state_dict(state_dict, assign=True)
+    model.inference_checkpoint = path
+    return model.to(device)
+
+
+def convert(kind: str, training_path: str, output_path: str, fp16: bool = False) -> dict:
+    """Writes the inference checkpoint of a MED / MSC training checkpoint.
+
+    The checkpoint holds contiguous tensors in a zip file, so it can be memory mapped; the PCEN parameters
+    exponentiated, as the inference forward uses them; and none of the modules the forward does not use
+    (the MSC `out` head). With fp16 floating point tensors are stored in half precision, half the file
+    size, but they are widened to fp32 copies at load and no longer shared between processes."""
+    state_dict = torch.load(training_path, map_location="cpu")
+    unused = [key for key in state_dict if key.split(".")[0] in UNUSED_MODULES[kind]]
+    for key in unused:
+        del state_dict[key]
+    pcen = {name: torch.exp(state_dict.pop(f"pcen_layer.log_{name}")).item() for name in PCEN_PARAMETERS}
+
+    def pack(tensor: torch.Tensor) -> torch.Tensor:
+        if fp16 and tensor.is_floating_point():
+            tensor = tensor.half()
+        # clone so a view does not drag its whole storage into the file
+        return tensor.contiguous().clone()
+
+    torch.save({
+        "format": INFERENCE_FORMAT,
+        "kind": kind,
+        "source": os.path.basename(training_path),
+        "state_dict": {key: pack(value) for key, value in state_dict.items()},
+        "pcen": pcen,
+        "unused_modules": list(UNUSED_MODULES[kind]),
+    }, output_path)
+    report = {
+        "output": output_path,
+        "tensors": len(state_dict),
+        "dropped": unused,
+        "pcen": pcen,
+        "fp16": fp16,
+        "training_bytes": os.path.getsize(training_path),
+        "inference_bytes": os.path.getsize(output_path),
+    }
+    logger.info("Converted {0}: {1}".format(training_path, report))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts a MED / MSC training checkpoint to a memory mappable inference checkpoint.")
+    parser.add_argument("kind", choices=tuple(UNUSED_MODULES))
+    parser.add_argument("training_checkpoint")
+    parser.add_argument("output")
+    parser.add_argument("--fp16", action="store_true", help="store floating point tensors in half precision")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    print(json.dumps(convert(arguments.kind, arguments.training_checkpoint, arguments.output, arguments.fp16), indent=4))
@@ -1,32 +1,197 @@
+import logging
+import os
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Callable
+from typing import TYPE_CHECKING, Callable, Iterator
 
 import numpy as np
-import soundfile as sf
-import torch
 
 from lib.config import Config
 from lib.custom_types import (DetectedEvents, Environment,
                               SpeciesClassificationResponse)
-from lib.med.event_detector import EventDetector
-from lib.msc.species_classifier import SpeciesClassifier
-from lib.storage.recording_storage import RecordingStorage
-from lib.utils import get_audio_with_events, prepare
+from lib.exceptions import UserCancelledError
+from lib.model_manager import ModelManager
+from lib.result_cache import ResultCache, result_key
 
+# torch, timm and the models are imported by the loader, so a service can answer before they are loaded
+if TYPE_CHECKING:
+    import torch
 
+    from lib.med.event_detector import EventDetector
+    from lib.med.streaming_detector import StreamingEventDetector
+    from lib.msc.species_classifier import SpeciesClassifier
+    from lib.runtime import ThreadTopology
+    from lib.storage.recording_storage import (AudioRecording,
+                                                RecordingStorage,
+                                                StreamingRecording)
+
+
+"""
+Runs MED and MSC for the services.
+The models are managed by a ModelManager (lib/model_manager.py): each is loaded, and warmed up with a forward
+through it, when it is first used, within the MODEL_MEMORY_BUDGET, and evicted after MODEL_IDLE_TTL seconds
+without use. `load` configures the torch threads and loads the models of PRELOAD_MODELS, in parallel. With
+background=True the constructor returns right away and `load` runs on a thread, so a service can bind its port
+and answer /health meanwhile; `ready` is set once the preloaded models are loaded and warmed up. Calls that
+need a model hold a lease on it (`models.lease("med")`) and wait while it loads. `load_status()` reports the
+state of the loading.
+"""
 class Classifier:
-    recording_storage: RecordingStorage
-    event_detector: EventDetector
-    species_classifier: SpeciesClassifier
+    result_cache: ResultCache | None
     environment: Environment
+    models: ModelManager
 
-    def __init__(self, environment: Environment):
+    def __init__(self, environment: Environment, runtime: "ThreadTopology | None" = None, background: bool = False):
         print("Initializing classifier with Environment: ", environment.__str__())
+        self.logger = logging.getLogger('Classifier')
         self.environment = environment
-        self.data_source = RecordingStorage(environment.database_url)
-        self.species_classifier = SpeciesClassifier(model_path=environment.species_classifier_model_path)
-        self.event_detector = EventDetector(model_path=environment.event_detector_model_path)
+        self.runtime = runtime
+        self.result_cache = ResultCache(environment.result_cache_bytes, environment.result_cache_dir) if environment.result_cache_bytes > 0 or environment.result_cache_dir else None
+        self._data_source = None
+        self._load_error: Exception | None = None
+        self._load_seconds: float | None = None
+        # How the models ran once loaded, by name, kept when they are evicted (see _inference_settings)
+        self._resolved_settings: dict[str, dict] = {}
+        self.models = ModelManager(environment.model_memory_budget, environment.model_idle_ttl)
+        # Until the weights are read, the checkpoint size estimates what a model takes in the budget
+        self.models.register("med", self._load_event_detector, self._unload, self._resident_bytes, self._checkpoint_bytes(environment.event_detector_model_path))
+        self.models.register("msc", self._load_species_classifier, self._unload, self._resident_bytes, self._checkpoint_bytes(environment.species_classifier_model_path))
+        # Set once the threads are configured, models are only loaded afterwards, and once the preloaded models are warmed up
+        self.configured = threading.Event()
+        self.ready = threading.Event()
+        if background:
+            threading.Thread(target=self.load, name="ClassifierLoader", daemon=True).start()
+        else:
+            self.load()
+            if self._load_error is not None:
+                raise self._load_error
+
+    def load(self):
+        started = time.perf_counter()
+        try:
+            if self.runtime is not None:
+                self.runtime.configure()
+            self.configured.set()
+            # torch releases the GIL while reading and converting the weights, the models load side by side
+            with ThreadPoolExecutor(max_workers=2, thread_name_prefix="model-loader") as loader:
+                for preloaded in [loader.submit(self._preload, name) for name in self.environment.preload_models]:
+                    preloaded.result()
+        except Exception as e:
+            self.logger.exception("Loading the models failed")
+            self._load_error = e
+            # Models loaded on first use go ahead with the threads as they are
+            self.configured.set()
+            return
+        self._load_seconds = time.perf_counter() - started
+        self.ready.set()
+        self.logger.info("Models {0} loaded and warmed up in {1:.1f}s, ready".format(self.environment.preload_models, self._load_seconds))
+
+    def _preload(self, name: str):
+        self.models.acquire(name)
+        self.models.release(name)
+
+    def _model_options(self) -> dict:
+        environment = self.environment
+        return {"batch_size": environment.inference_batch_size, "backend": environment.inference_backend, "quantization": environment.quantization, "precision": environment.precision}
+
+    def _load_event_detector(self) -> "EventDetector":
+        from lib.med.event_detector import EventDetector
+
+        self.configured.wait()
+        event_detector = EventDetector(self.environment.event_detector_model_path, **self._model_options())
+        if self.environment.med_shared_stft and not event_detector.shared_stft_verified:
+            self.logger.warning("MED_SHARED_STFT ignored: {0} has not passed testing/med_shared_stft_test.py, windows go through the STFT one by one".format(event_detector.model_checkpoint))
+        return self._prepare("med", event_detector)
+
+    def _load_species_classifier(self) -> "SpeciesClassifier":
+        from lib.msc.species_classifier import SpeciesClassifier
+
+        self.configured.wait()
+        return self._prepare("msc", SpeciesClassifier(self.environment.species_classifier_model_path, **self._model_options()))
+
+    # Gives a loaded model its own worker processes and batcher thread, then warms it up.
+    def _prepare(self, name: str, model: "EventDetector | SpeciesClassifier") -> "EventDetector | SpeciesClassifier":
+        environment = self.environment
+        if environment.inference_processes > 0:
+            from lib.process_pool import InferenceProcessPool
+            model.enable_process_pool(InferenceProcessPool({name: model.module}, environment.inference_processes))
+        if environment.micro_batch_wait_ms > 0:
+            # The batcher thread runs the forwards of every worker, it gets all cores
+            initializer = self.runtime.initialize_shared if self.runtime is not None else None
+            model.enable_micro_batching(environment.micro_batch_size, environment.micro_batch_wait_ms, initializer)
+        self.warm_up(model)
+        self._resolved_settings[name] = {
+            "quantization": model.quantization_report["mode"],
+            "backend": model.backend_report["backend"],
+            "precision": model.backend_report["precision"],
+        }
+        return model
+
+    # Part of the result cache keys: the settings the models resolved to once loaded, the requested ones before.
+    # Results are only stored once their models are loaded, under the resolved settings, so results computed with
+    # a quantized or bf16 model are never returned for an fp32 one and back.
+    def _inference_settings(self, names: list[str]) -> dict[str, dict]:
+        environment = self.environment
+        requested = {"quantization": environment.quantization, "backend": environment.inference_backend, "precision": environment.precision}
+        return {name: self._resolved_settings.get(name, requested) for name in names}
+
+    @staticmethod
+    def _unload(model: "EventDetector | SpeciesClassifier"):
+        model.close()
+
+    @staticmethod
+    def _resident_bytes(model: "EventDetector | SpeciesClassifier") -> int:
+        return model.resident_bytes()
+
+    @staticmethod
+    def _checkpoint_bytes(model_path: str | None) -> int:
+        return os.path.getsize(model_path) if model_path and os.path.exists(model_path) else 0
+
+    # One window through the model, so the first request does not pay for lazy allocations and backend setup.
+    def warm_up(self, model: "EventDetector | SpeciesClassifier", config: Config = Config.default()):
+        import torch
+
+        model.predict(torch.zeros(1, int(config.sample_rate * config.min_length)))
+
+    def load_status(self) -> dict:
+        return {
+            "ready": self.ready.is_set(),
+            "error": "{0}: {1}".format(type(self._load_error).__name__, self._load_error) if self._load_error is not None else None,
+            "preload": self.environment.preload_models,
+            "load_seconds": self._load_seconds,
+            "models": self.models.stats()["models"],
+        }
+
+    # Budget, resident bytes, per model state and the recent load / evict events of the ModelManager.
+    def model_stats(self) -> dict:
+        return self.models.stats()
+
+    # Opened on first use, the live service never reads recordings from the database
+    @property
+    def data_source(self) -> "RecordingStorage":
+        if self._data_source is None:
+            from lib.storage.audio_cache import DecodedAudioCache
+            from lib.storage.recording_storage import RecordingStorage
+            audio_cache = DecodedAudioCache(self.environment.audio_cache_dir, self.environment.audio_cache_dtype) if self.environment.audio_cache_dir else None
+            self._data_source = RecordingStorage(self.environment.database_url, audio_cache)
+        return self._data_source
+
+    def audio_cache_stats(self) -> dict | None:
+        if self._data_source is None or self._data_source.audio_cache is None:
+            return None
+        return self._data_source.audio_cache.stats()
+
+    def shutdown(self):
+        self.models.shutdown()
+
+    # Metrics of the loaded models, they start over when a model is loaded again.
+    def batching_metrics(self) -> dict:
+        return {
+            name: model.batcher.metrics.snapshot() if model is not None and model.batcher is not None else None
+            for name, model in ((name, self.models.peek(name)) for name in ("med", "msc"))
+        }
 
     def med_recording(
         self,
@@ -35,20 +200,66 @@ class Classifier:
         send_update_to_client: Callable[[float, str], None] | None = None,
         config: Config = Config.default()
     ) -> str:
-        # Fetch the recording
-        recording = self.data_source.fetch(recording_id, config)
+        # Fetch the recording, it is decoded while its windows are classified
+        recording = self.fetch_recording(recording_id, config)
+
+        # Detect events in the recording, PIPELINE_CHUNK_WINDOWS windows of audio at a time
+        with self.models.lease("med") as event_detector:
+            total, segments = self.med_segments(event_detector, recording, self.environment.pipeline_chunk_windows, config)
+            probabilities: list[np.ndarray] = []
+            for first, count, predict_windows in segments:
+                for start in range(0, count, event_detector.batch_size):
+                    if abort_signal is not None and abort_signal.is_set():
+                        raise UserCancelledError()
+                    end = min(start + event_detector.batch_size, count)
+                    probabilities.append(predict_windows(start, end).cpu().numpy().astype(np.float64))
+                    if send_update_to_client is not None:
+                        send_update_to_client((first + end - 1) / total * 100, f"Window {first + end} of {total} has been classified.")
+            events = DetectedEvents(np.concatenate(probabilities) if probabilities else np.empty((0, 2)), event_detector.model_checkpoint)
+
+        return self.finalize_med_recording(recording, events, config)
+
+    # The steps of med_recording, for schedulers that interleave the window batches of several recordings.
+    # The recording is not decoded yet, see RecordingStorage.stream.
+    def fetch_recording(self, recording_id: str, config: Config = Config.default()) -> "StreamingRecording | AudioRecording":
+        return self.data_source.stream(recording_id, config)
+
+    # Returns the number of windows of the recording and an iterator over its segments of `windows_per_segment`
+    # windows, each as (first window, number of windows, function predicting windows [start, end) of the segment).
+    # The recording is decoded as the iterator advances; usable while the caller holds its lease on the event detector.
+    def med_segments(self, event_detector: "EventDetector", recording: "StreamingRecording | AudioRecording", windows_per_segment: int, config: Config = Config.default()) -> "tuple[int, Iterator[tuple[int, int, Callable[[int, int], torch.Tensor]]]]":
+        import torch
+
+        window_length, step_length = config.single_batch_length(), config.step_size * config.n_hop
+
+        def segments():
+            first = 0
+            for segment in recording.segments(windows_per_segment, config):
+                signal = torch.from_numpy(segment)
+                if self.environment.med_shared_stft and event_detector.shared_stft_verified:
+                    count, predict_windows = event_detector.signal_predictor(signal, window_length, step_length)
+                else:
+                    count, predict_windows = event_detector.window_predictor(signal.unfold(0, window_length, step_length))
+                yield first, count, predict_windows
+                first += count
+
+        return recording.windows, segments()
+
+    # Writes the detected events of the recording as a csv and their audio as a wav to the output directory.
+    def finalize_med_recording(self, recording: "StreamingRecording | AudioRecording", events: DetectedEvents, config: Config = Config.default()):
+        import soundfile as sf
 
-        # Detect events in the recording
-        events = self.event_detector.detect(recording.bytes, send_update_to_client, abort_signal)
+        from lib.audio_stream import cut_ranges
 
         timestamp_df = events.get_data_frame_with_recording(config, recording)
         path_to_outputs = Path(self.environment.output_dir)
         wav_file_name = Path(path_to_outputs, f"{str(recording.id)}.wav")
 
-        signal = recording.bytes.numpy()
-
-        mozz_audio_list = [signal[0][int(float(row["med_start_time"]) * recording.sample_rate):int(float(row["med_stop_time"]) * recording.sample_rate)] for _, row in timestamp_df.iterrows()]
-        sf.write(Path( wav_file_name), np.hstack(mozz_audio_list), recording.sample_rate)
+        # The audio of the events is cut from the recording as it is decoded again, block by block
+        event_ranges = [(int(float(row["med_start_time"]) * recording.sample_rate), int(float(row["med_stop_time"]) * recording.sample_rate)) for _, row in timestamp_df.iterrows()]
+        with sf.SoundFile(wav_file_name, "w", samplerate=recording.sample_rate, channels=1) as wav_file:
+            for samples in cut_ranges(recording.blocks(), event_ranges):
+                wav_file.write(samples)
         output_path = Path(path_to_outputs,f"{str(recording.id)}.csv")
         path_to_med_df = Path(path_to_outputs,f'{recording.id}.csv' )
         timestamp_df.to_csv(path_to_med_df, index=False)
@@ -58,16 +269,70 @@ class Classifier:
         pass
 
     def med(self, bytes: np.ndarray, send_update_to_client: Callable[[float, str], None] | None = None, abort_signal: threading.Event | None = None, config: Config = Config.default() ) -> DetectedEvents:
-        return self.event_detector.detect(torch.FloatTensor(prepare(bytes, config)), send_update_to_client, abort_signal)
+        import torch
+
+        from lib.utils import prepare
+
+        key = self._result_key("med", bytes, ["med"], config)
+        cached = self._cached(key, DetectedEvents.from_dict, send_update_to_client)
+        if cached is not None:
+            return cached
+
+        with self.models.lease("med") as event_detector:
+            events = event_detector.detect(torch.FloatTensor(prepare(bytes, config)), send_update_to_client, abort_signal)
+        if self.result_cache is not None:
+            # Keyed again now the model is loaded, under the settings it resolved to
+            self.result_cache.put(self._result_key("med", bytes, ["med"], config), events)
+        return events
+
+    # The stream holds a lease on the event detector until it is closed.
+    def med_stream(self, config: Config = Config.default()) -> "StreamingEventDetector":
+        from lib.med.streaming_detector import StreamingEventDetector
+        event_detector = self.models.acquire("med")
+        return StreamingEventDetector(event_detector, config, release=lambda: self.models.release("med"))
 
     def msc(self, bytes: np.ndarray, send_update_to_client: Callable[[float, str], None] | None = None, abort_signal: threading.Event | None = None, config: Config = Config.default()) -> SpeciesClassificationResponse:
+        import torch
+
+        from lib.utils import get_audio_with_events
+
+        key = self._result_key("msc", bytes, ["med", "msc"], config)
+        cached = self._cached(key, SpeciesClassificationResponse.from_dict, send_update_to_client)
+        if cached is not None:
+            return cached
 
         print("Detecting events first")
-        events = self.med(bytes, send_update_to_client, abort_signal)        
+        events = self.med(bytes, send_update_to_client, abort_signal, config)
         if events.get_data_frame(config=config).empty or not events.has_events(detect_threshold=config.det_threshold):
-            return SpeciesClassificationResponse.no_events_detected(events, self.species_classifier.model_checkpoint)
+            results = SpeciesClassificationResponse.no_events_detected(events, self._checkpoint(self.environment.species_classifier_model_path))
+        else:
+            print("detected events! ")
+            events_audio = get_audio_with_events(bytes, events, config)
+            with self.models.lease("msc") as species_classifier:
+                results = species_classifier.classify(torch.FloatTensor(events_audio), send_update_to_client=send_update_to_client,detected_events=events, abort_signal=abort_signal, config=config)
+
+        if self.result_cache is not None:
+            self.result_cache.put(self._result_key("msc", bytes, ["med", "msc"], config), results)
+        return results
+
+    # Results are looked up before their models are loaded, so a hit does not wait for them, and stored under the
+    # key computed again after the models ran, with the settings they resolved to (_inference_settings).
+    def _result_key(self, kind: str, samples: np.ndarray, names: list[str], config: Config) -> str:
+        paths = {"med": self.environment.event_detector_model_path, "msc": self.environment.species_classifier_model_path}
+        return result_key(kind, samples, [self._checkpoint(paths[name]) for name in names], config, self._inference_settings(names))
+
+    # Same name as the loaded model's model_checkpoint, known before the model is loaded so cache hits do not wait for it
+    @staticmethod
+    def _checkpoint(model_path: str) -> str:
+        return model_path.split("/")[-1]
 
-        print("detected events! ")
-        events_audio = get_audio_with_events(bytes, events, config)
-        return self.species_classifier.classify(torch.FloatTensor(events_audio), send_update_to_client=send_update_to_client,detected_events=events, abort_signal=abort_signal, config=config)    
+    def _cached(self, key: str, from_dict: Callable, send_update_to_client: Callable[[float, str], None] | None):
+        if self.result_cache is None:
+            return None
+        cached = self.result_cache.get(key, from_dict)
+        if cached is not None and send_update_to_client is not None:
+            send_update_to_client(100, "Result loaded from cache.")
+        return cached
 
+    def result_cache_stats(self) -> dict | None:
+        return self.result_cache.stats() if self.result_cache is not None else None
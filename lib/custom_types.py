@@ -1,10 +1,14 @@
-
+from typing import TYPE_CHECKING
 
 import numpy as np
 import pandas as pd
 
 from lib.config import Config
-from lib.storage.recording_storage import AudioRecording
+
+# Only for annotations, the storage pulls in torch, librosa and pymongo
+if TYPE_CHECKING:
+    from lib.storage.recording_storage import (AudioRecording,
+                                                StreamingRecording)
 
 
 class Environment: 
@@ -12,15 +16,75 @@ class Environment:
     output_dir: str
     event_detector_model_path: str
     species_classifier_model_path: str
+    # Number of windows pushed through a model in a single forward.
+    inference_batch_size: int
+    # Compute the MED spectrogram once per recording and slice it for the overlapping windows.
+    med_shared_stft: bool
+    # Threads running inference in the live service, requests beyond this wait in a queue.
+    inference_workers: int
+    # Batch windows of concurrent requests into shared forwards, waiting at most this long (0 disables).
+    micro_batch_wait_ms: float
+    micro_batch_size: int
+    # Worker processes running the model forwards, 0 runs them in the service process.
+    inference_processes: int
+    # Recordings the pipeline processes at the same time.
+    pipeline_workers: int
+    # Windows the pipeline classifies before it may switch to another recording.
+    pipeline_chunk_windows: int
+    # Memory budget of the MED/MSC result cache in bytes (0 disables it) and an optional directory to persist it.
+    result_cache_bytes: int
+    result_cache_dir: str | None
+    # How the model backbones run: eager, torchscript, compile or onnx (see lib/backends.py).
+    inference_backend: str
+    # "dynamic" runs the Linear layers of the model backbones in int8 (see lib/quantization.py), "none" keeps fp32.
+    quantization: str
+    # "bf16" runs the model backbones under CPU autocast in channels_last where the CPU supports it, "fp32" does not.
+    precision: str
+    # torch intra-op threads per inference / pipeline worker (0 splits the cores evenly), inter-op threads,
+    # and whether every worker is pinned to its own cores (see lib/runtime.py).
+    torch_threads: int
+    torch_interop_threads: int
+    pin_threads: bool
+    # Budget of the resident model weights in bytes (0 for none) and the seconds an unused model stays
+    # loaded (0 keeps it), see lib/model_manager.py. Models in preload_models are loaded at startup, the
+    # others on first use.
+    model_memory_budget: int
+    model_idle_ttl: float
+    preload_models: list[str]
+    # Directory of the disk cache of decoded recordings (unset disables it) and the dtype of its entries,
+    # float32 or int16 (see lib/storage/audio_cache.py).
+    audio_cache_dir: str | None
+    audio_cache_dtype: str
     
     def __init__(self, env: dict):
         self.database_url = env.get("DATABASE_URL")
         self.event_detector_model_path = env.get("EVENT_DETECTOR_MODEL_PATH")
         self.species_classifier_model_path = env.get("SPECIES_CLASSIFIER_MODEL_PATH")
         self.output_dir = env.get("CLASSIFICATION_OUTPUT_DIR")
+        self.inference_batch_size = int(env.get("INFERENCE_BATCH_SIZE", 1))
+        self.med_shared_stft = str(env.get("MED_SHARED_STFT", "false")).lower() == "true"
+        self.inference_workers = int(env.get("INFERENCE_WORKERS", 1))
+        self.micro_batch_wait_ms = float(env.get("MICRO_BATCH_WAIT_MS", 0))
+        self.micro_batch_size = int(env.get("MICRO_BATCH_SIZE", 16))
+        self.inference_processes = int(env.get("INFERENCE_PROCESSES", 0))
+        self.pipeline_workers = int(env.get("PIPELINE_WORKERS", 1))
+        self.pipeline_chunk_windows = int(env.get("PIPELINE_CHUNK_WINDOWS", 32))
+        self.result_cache_bytes = int(env.get("RESULT_CACHE_BYTES", 64 * 1024 * 1024))
+        self.result_cache_dir = env.get("RESULT_CACHE_DIR") or None
+        self.inference_backend = str(env.get("INFERENCE_BACKEND", "eager")).lower()
+        self.quantization = str(env.get("QUANTIZATION", "none")).lower()
+        self.precision = str(env.get("PRECISION", "fp32")).lower()
+        self.torch_threads = int(env.get("TORCH_THREADS", 0))
+        self.torch_interop_threads = int(env.get("TORCH_INTEROP_THREADS", 1))
+        self.pin_threads = str(env.get("PIN_THREADS", "false")).lower() == "true"
+        self.model_memory_budget = int(env.get("MODEL_MEMORY_BUDGET", 0))
+        self.model_idle_ttl = float(env.get("MODEL_IDLE_TTL", 0))
+        self.preload_models = [name.strip().lower() for name in str(env.get("PRELOAD_MODELS", "med,msc")).split(",") if name.strip()]
+        self.audio_cache_dir = env.get("AUDIO_CACHE_DIR") or None
+        self.audio_cache_dtype = str(env.get("AUDIO_CACHE_DTYPE", "float32")).lower()
     
     def __str__(self):
-        return f"Environment(database_url={self.database_url}, output_dir={self.output_dir}, event_detector_model_path={self.event_detector_model_path}, species_classifier_model_path={self.species_classifier_model_path})"
+        return f"Environment(database_url={self.database_url}, output_dir={self.output_dir}, event_detector_model_path={self.event_detector_model_path}, species_classifier_model_path={self.species_classifier_model_path}, inference_batch_size={self.inference_batch_size}, med_shared_stft={self.med_shared_stft}, inference_workers={self.inference_workers}, micro_batch_wait_ms={self.micro_batch_wait_ms}, micro_batch_size={self.micro_batch_size}, inference_processes={self.inference_processes}, pipeline_workers={self.pipeline_workers}, pipeline_chunk_windows={self.pipeline_chunk_windows}, result_cache_bytes={self.result_cache_bytes}, result_cache_dir={self.result_cache_dir}, inference_backend={self.inference_backend}, quantization={self.quantization}, precision={self.precision}, torch_threads={self.torch_threads}, torch_interop_threads={self.torch_interop_threads}, pin_threads={self.pin_threads}, model_memory_budget={self.model_memory_budget}, model_idle_ttl={self.model_idle_ttl}, preload_models={self.preload_models}, audio_cache_dir={self.audio_cache_dir}, audio_cache_dtype={self.audio_cache_dtype})"
 
 class DetectedEvents:
     def __init__(self, predictions_array: np.ndarray, model: str):
@@ -48,13 +112,14 @@ class DetectedEvents:
         mean_predictions = np.mean(predictions_array_samples, axis=0)
         return self._build_timestamp_df(mean_predictions, config.min_length, config.det_threshold)
     
-    # def get_data_frame_with_recording(self, config: Config, recording: AudioRecording) -> pd.DataFrame:
-    #     predictions_array = self.predictions_array
-    #     predictions_array_samples = np.array([predictions_array[:-4], predictions_array[1:-3], predictions_array[2:-2]])
-    #     mean_predictions = np.mean(predictions_array_samples, axis=0)
-    #     return self._build_timestamp_df(mean_predictions, (config.n_hop * config.step_size / 8000), config.det_threshold, recording)
+    # Windows of a recording overlap, consecutive windows start n_hop * step_size samples apart.
+    def get_data_frame_with_recording(self, config: Config, recording: "AudioRecording | StreamingRecording") -> pd.DataFrame:
+        predictions_array = self.predictions_array
+        predictions_array_samples = np.array([predictions_array[:-4], predictions_array[1:-3], predictions_array[2:-2]])
+        mean_predictions = np.mean(predictions_array_samples, axis=0)
+        return self._build_timestamp_df(mean_predictions, (config.n_hop * config.step_size / config.sample_rate), config.det_threshold, recording)
         
-    def _build_timestamp_df(self,predictions, time_to_sample, det_threshold, recording: AudioRecording | None = None) -> pd.DataFrame:
+    def _build_timestamp_df(self,predictions, time_to_sample, det_threshold, recording: "AudioRecording | StreamingRecording | None" = None) -> pd.DataFrame:
         """Use the predictions to build an array of contiguous timestamps where the
         probability of detection is above threshold"""
         # find where the average 2nd element (positive score) is > threshold
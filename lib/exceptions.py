@@ -42,4 +42,13 @@ class LoadingAudioBytesError(DescriptiveError):
         )
 
 class UserCancelledError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class InvalidAudioFrameError(DescriptiveError):
+    def __init__(self, reason: str):
+        super().__init__(
+            "invalid_audio_frame",
+            "Invalid audio frame",
+            reason,
+            400
+        )
@@ -0,0 +1,201 @@
+from functools import lru_cache
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from nnAudio import features
+from nnAudio.utils import broadcast_dim
+
+
+# Inference helpers shared by the MED and MSC spectrogram frontends.
+
+@lru_cache(maxsize=16)
+def pcen_smoothing_weights(length: int, s: float, dtype: torch.dtype, device: torch.device) -> torch.Tensor:
+    """Lower triangular (length, length) matrix W with W[t, k] = s * (1 - s) ** (t - k) for k <= t.
+
+    W @ x runs the first-order IIR smoother of PCEN, M[0] = s * x[0] and M[t] = (1 - s) * M[t - 1] + s * x[t],
+    over the rows of x in one op. The weights are built in float64 so the decay does not lose precision."""
+    steps = torch.arange(length, dtype=torch.float64)
+    lags = (steps[:, None] - steps[None, :]).clamp(min=0)
+    weights = s * torch.pow(torch.tensor(1 - s, dtype=torch.float64), lags)
+    return torch.tril(weights).to(dtype=dtype, device=device)
+
+
+def pcen_smooth(x: torch.Tensor, s) -> torch.Tensor:
+    """Vectorized equivalent of the frame by frame PCEN smoother, along dim -2 of x (B, F, T)."""
+    s = s.item() if isinstance(s, torch.Tensor) else float(s)
+    weights = pcen_smoothing_weights(x.shape[-2], s, x.dtype, x.device)
+    return torch.matmul(weights, x)
+
+
+def _next_fast_length(n: int) -> int:
+    # Smallest 2^a * 3^b * 5^c >= n, sizes the FFT backends handle efficiently
+    while True:
+        m = n
+        for prime in (2, 3, 5):
+            while m % prime == 0:
+                m //= prime
+        if m == 1:
+            return n
+        n += 1
+
+
+class InferenceSTFT(nn.Module):
+    """Inference-only replacement for a trainable nnAudio STFT with output_format="Magnitude".
+
+    nnAudio computes the spectrogram as a 1-D convolution with windowed Fourier kernels. When the kernels
+    loaded from the checkpoint are still the plain Hann windowed Fourier bases they were initialised with,
+    the same magnitudes are computed with FFTs instead. The bins of freq_scale="linear" are linearly spaced
+    but not on the DFT grid (fmin/fmax), so the FFT path evaluates them with a chirp-z transform (Bluestein).
+    If the kernels have drifted during training the convolution is kept.
+
+    The chosen path and the measured deviations are available in `report`."""
+
+    def __init__(self, stft: features.STFT, tolerance: float = 1e-5):
+        super().__init__()
+        self.n_fft = stft.n_fft
+        self.hop_length = stft.stride
+        self.center = stft.center
+        self.pad_mode = stft.pad_mode
+        self.pad_amount = stft.pad_amount
+        self.freq_bins = stft.freq_bins
+        # Trainable nnAudio layers add 1e-8 before the sqrt, keep it for parity
+        self.magnitude_eps = 1e-8 if stft.trainable else 0.0
+
+        wsin = stft.wsin.detach()
+        wcos = stft.wcos.detach()
+        window = stft.window_mask.detach().flatten().double().cpu()
+        bins = np.asarray(stft.bin_list, dtype=np.float64)
+
+        kernel_deviation = self._kernel_deviation(wsin, wcos, window, bins)
+        linear_bins = len(bins) > 1 and np.allclose(np.diff(bins), bins[1] - bins[0], rtol=0, atol=1e-9)
+        self.path = "fft" if linear_bins and kernel_deviation < tolerance else "conv"
+
+        if self.path == "fft":
+            self._build_chirp_z(window, bins[0], bins[1] - bins[0], len(bins), wcos.device)
+        else:
+            self.register_buffer("wsin", wsin, persistent=False)
+            self.register_buffer("wcos", wcos, persistent=False)
+
+        self.report = {
+            "path": self.path,
+            "n_fft": self.n_fft,
+            "hop_length": self.hop_length,
+            "kernel_deviation": kernel_deviation,
+            "output_error": self._output_error(stft),
+        }
+
+    def _kernel_deviation(self, wsin: torch.Tensor, wcos: torch.Tensor, window: torch.Tensor, bins: np.ndarray) -> float:
+        # Relative max deviation of the loaded kernels from freshly built Hann windowed Fourier bases
+        if wsin.shape[0] != len(bins) or wsin.shape[-1] != self.n_fft:
+            return float("inf")
+        phase = 2 * np.pi * np.outer(bins, np.arange(self.n_fft)) / self.n_fft
+        reference_sin = torch.from_numpy(np.sin(phase)) * window
+        reference_cos = torch.from_numpy(np.cos(phase)) * window
+        deviation = max(
+            (wsin.squeeze(1).double().cpu() - reference_sin).abs().max().item(),
+            (wcos.squeeze(1).double().cpu() - reference_cos).abs().max().item(),
+        )
+        return deviation / window.abs().max().item()
+
+    def _build_chirp_z(self, window: torch.Tensor, first_bin: float, bin_step: float, n_bins: int, device: torch.device):
+        # X[k] = sum_n x[n] w[n] exp(-2j pi (first_bin + k * bin_step) n / n_fft), written with nk = (n^2 + k^2 - (k - n)^2) / 2
+        # as a convolution of x[n] w[n] exp(-2j pi first_bin n / n_fft - j pi step n^2) with the chirp exp(j pi step m^2).
+        # The trailing exp(-j pi step k^2) factor has unit modulus and is dropped since only magnitudes are returned.
+        n = torch.arange(self.n_fft, dtype=torch.float64)
+        step = bin_step / self.n_fft
+        # Reduce phases (in half turns) modulo 2 in float64 before they meet float32
+        pre_phase = torch.remainder(2 * first_bin * n / self.n_fft + step * n * n, 2)
+        pre_chirp = window * torch.exp(-1j * np.pi * pre_phase)
+
+        self.fft_length = _next_fast_length(self.n_fft + n_bins - 1)
+        m = torch.arange(self.fft_length, dtype=torch.float64)
+        # Chirp indices -(n_fft - 1) .. n_bins - 1, wrapped around for the circular convolution
+        lags = torch.where(m < n_bins, m, m - self.fft_length)
+        chirp = torch.exp(1j * np.pi * torch.remainder(step * lags * lags, 2))
+        chirp[(m >= n_bins) & (m <= self.fft_length - self.n_fft)] = 0
+
+        self.n_bins = n_bins
+        self.register_buffer("pre_chirp", pre_chirp.to(torch.complex64).to(device), persistent=False)
+        self.register_buffer("chirp_fft", torch.fft.fft(chirp).to(torch.complex64).to(device), persistent=False)
+
+    def _output_error(self, stft: features.STFT) -> float:
+        # Relative max deviation from the nnAudio layer on a probe signal
+        probe = torch.randn(1, self.n_fft * 4, generator=torch.Generator().manual_seed(0)).to(stft.wsin.device)
+        with torch.no_grad():
+            reference = stft(probe)
+            output = self(probe)
+        return ((output - reference).abs().max() / reference.abs().max()).item()
+
+    def forward(self, x: torch.Tensor, center: bool | None = None) -> torch.Tensor:
+        x = broadcast_dim(x)
+        if self.center if center is None else center:
+            x = F.pad(x, (self.pad_amount, self.pad_amount), mode=self.pad_mode)
+
+        if self.path == "fft":
+            frames = x[:, 0].unfold(-1, self.n_fft, self.hop_length)  # (B, T, n_fft)
+            spectrum = torch.fft.ifft(torch.fft.fft(frames * self.pre_chirp, n=self.fft_length) * self.chirp_fft)
+            spec = spectrum[..., :self.n_bins].transpose(1, 2)  # (B, F, T)
+            spec = spec.real.pow(2) + spec.imag.pow(2)
+        else:
+            spec_imag = F.conv1d(x, self.wsin, stride=self.hop_length)
+            spec_real = F.conv1d(x, self.wcos, stride=self.hop_length)
+            spec = spec_real.pow(2) + spec_imag.pow(2)
+
+        spec = spec[:, :self.freq_bins, :]
+        return torch.sqrt(spec + self.magnitude_eps)
+
+
+class FusedPostFrontend(nn.Module):
+    """Inference-only replacement for normalize -> Resize -> zero input check after PCEN.
+
+    The resize of a (B, F, T) spectrogram is separable, so it is done as two matmuls with interpolation
+    matrices read off the model's own Resize transform once per input shape. The normalization zeroes
+    frames whose min/max range is zero or not finite (the frames the NaN mask zeroed) in place, and the
+    zero input guard is folded into the second matmul as a per window bias, without branching on the data."""
+
+    def __init__(self, sizer: nn.Module, probe_chunk: int = 64):
+        super().__init__()
+        self.sizer = sizer
+        self.probe_chunk = probe_chunk
+        self._matrices: dict[tuple, tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]] = {}
+
+    def _probe(self, length: int, axis: int) -> torch.Tensor:
+        # Resizes one-hot inputs along `axis` (1 for height, 2 for width) and reads the interpolation weights back
+        columns = []
+        for start in range(0, length, self.probe_chunk):
+            count = min(self.probe_chunk, length - start)
+            basis = torch.zeros(count, length)
+            basis[torch.arange(count), torch.arange(start, start + count)] = 1
+            resized = self.sizer(basis.unsqueeze(3 - axis))  # (count, H', W')
+            columns.append(resized[:, :, 0] if axis == 1 else resized[:, 0, :])
+        return torch.cat(columns).T  # (size, length)
+
+    def resize_matrices(self, height: int, width: int, dtype: torch.dtype, device: torch.device):
+        key = (height, width, dtype, device)
+        if key not in self._matrices:
+            rows = self._probe(height, axis=1)
+            columns_t = self._probe(width, axis=2).T.contiguous()
+            # sum(rows @ x @ columns_t) == row_weights @ x @ column_weights, to test for all zero outputs on the small input
+            row_weights = rows.sum(0)
+            column_weights = columns_t.sum(1)
+            self._matrices[key] = tuple(m.to(dtype=dtype, device=device) for m in (rows, columns_t, row_weights, column_weights))
+        return self._matrices[key]
+
+    def forward(self, spec: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        batch, height, width = spec.shape
+        x_max = spec.amax(1, keepdim=True)
+        x_min = spec.amin(1, keepdim=True)
+        x_range = x_max - x_min
+        # These frames come out of (x - x_min) / x_range entirely NaN, which the mask assignment set to 0
+        degenerate = ~(torch.isfinite(x_range) & (x_range > 0))
+        spec = (spec - x_min).div_(x_range).masked_fill_(degenerate, 0)
+
+        rows, columns_t, row_weights, column_weights = self.resize_matrices(height, width, spec.dtype, spec.device)
+        zero_inputs = torch.matmul(torch.matmul(row_weights, spec), column_weights) == 0  # (B,)
+        guard = (zero_inputs * 1e-6).to(spec.dtype).repeat_interleave(rows.shape[0]).unsqueeze(1)
+
+        spec = torch.matmul(rows, spec)  # (B, H', T)
+        spec = torch.addmm(guard, spec.reshape(-1, width), columns_t).view(batch, rows.shape[0], columns_t.shape[1])
+        return spec.unsqueeze(1), spec
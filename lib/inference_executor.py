@@ -0,0 +1,56 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+
+# Bounded pool of threads that runs all model inference and audio decoding of a service, so the asyncio
+# event loop only does network IO. Calls beyond `workers` wait in the pool's queue instead of adding
+# threads that would compete with torch's own intra-op threads for the CPU. `initializer` runs on every
+# thread when it starts, e.g. ThreadTopology.initialize_worker.
+class InferenceExecutor:
+    def __init__(self, workers: int = 1, initializer: Callable[[], None] | None = None):
+        self.workers = max(1, workers)
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="inference", initializer=initializer)
+        self._lock = threading.Lock()
+        self.running = 0
+        self.queued = 0
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        with self._lock:
+            self.queued += 1
+        try:
+            future = self.pool.submit(functools.partial(self._call, fn, *args, **kwargs))
+        except RuntimeError:
+            # Shut down
+            self._dequeue()
+            raise
+        future.add_done_callback(self._dequeue_cancelled)
+        return await asyncio.wrap_future(future)
+
+    def _dequeue(self):
+        with self._lock:
+            self.queued -= 1
+
+    # A call cancelled while it waited (its caller went away, or shutdown) never reaches _call
+    def _dequeue_cancelled(self, future: Future):
+        if future.cancelled():
+            self._dequeue()
+
+    def _call(self, fn: Callable, *args, **kwargs):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    def status(self) -> dict:
+        with self._lock:
+            return {"workers": self.workers, "running": self.running, "queued": self.queued}
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -1,30 +1,83 @@
+import json
 import logging
+import os
 import threading
+from typing import Callable
 
 import numpy as np
 import torch
 import torch.nn.functional as F
 
+from lib.backends import apply_backend, process_pool_fallback
+from lib.batching import MicroBatcher
+from lib.checkpoints import load_model
 from lib.custom_types import DetectedEvents
 from lib.exceptions import UserCancelledError
 from lib.med.mids_med import MidsMEDModel
+from lib.process_pool import InferenceProcessPool
+from lib.quantization import parameter_bytes, quantize_backbone
+from lib.runtime import wrap_model
+
+# Max absolute difference in window probabilities between detect_signal and detect.
+SHARED_STFT_TOLERANCE = 0.1
+
+
+# Where testing/med_shared_stft_test.py records that a checkpoint passed, next to the checkpoint.
+def shared_stft_check_path(model_path: str) -> str:
+    return f"{os.path.splitext(model_path)[0]}.shared_stft.json"
+
+
+def _checkpoint_stamp(model_path: str) -> dict:
+    stat = os.stat(model_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+# Written once both modes found the same events on every recording checked.
+def write_shared_stft_check(model_path: str, max_difference: float):
+    with open(shared_stft_check_path(model_path), "w") as file:
+        json.dump({"checkpoint": _checkpoint_stamp(model_path), "tolerance": SHARED_STFT_TOLERANCE, "max_difference": max_difference, "identical_events": True}, file)
+
+
+# Whether the checkpoint, as it is now, passed the check with the current tolerance.
+def shared_stft_verified(model_path: str) -> bool:
+    try:
+        with open(shared_stft_check_path(model_path)) as file:
+            check = json.load(file)
+        stamp = _checkpoint_stamp(model_path)
+    except (OSError, ValueError):
+        return False
+    return (check.get("checkpoint") == stamp and check.get("tolerance") == SHARED_STFT_TOLERANCE
+            and check.get("max_difference", float("inf")) <= SHARED_STFT_TOLERANCE and check.get("identical_events") is True)
 
 
 class EventDetector:
-    model: MidsMEDModel
+    # The loaded model, and the one forwards go through: the same module unless it is spread over several GPUs
+    module: MidsMEDModel
+    model: torch.nn.Module
 
-    def __init__(self, model_path: str):
+    def __init__(self, model_path: str, batch_size: int = 1, backend: str = "eager", quantization: str = "none", precision: str = "fp32"):
         self.logger = logging.getLogger('EventDetector')
+        self.batch_size = max(1, batch_size)
+        self.batcher: MicroBatcher | None = None
+        self.process_pool: InferenceProcessPool | None = None
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'mps' if torch.backends.mps.is_available() else 'cpu')
 
-        model = MidsMEDModel()
         print("Loading MED model from {0}".format(model_path))
-        model.load_state_dict(torch.load(model_path, map_location=self.device))
+        # Training or inference checkpoint (lib/checkpoints.py), memory mapped when possible
+        model = load_model(MidsMEDModel, model_path, self.device)
         model.eval()
-        self.model = model
-        self.model = torch.nn.DataParallel(model).to(self.device)
+        self.frontend_report = model.prepare_for_inference()
+        self.quantization_report = quantize_backbone(model, quantization)
+        self.backend_report = apply_backend(model, backend, model_path, self.batch_size, precision)
+        self.module = model
+        self.model = wrap_model(model, self.device)
 
         self.model_checkpoint = model_path.split("/")[-1]
+        # detect_signal may replace detect only for checkpoints testing/med_shared_stft_test.py passed
+        self.shared_stft_verified = shared_stft_verified(model_path)
+        self.logger.info("MED STFT frontend for checkpoint {0}: {1}".format(self.model_checkpoint, self.frontend_report))
+        self.logger.info("MED quantization for checkpoint {0}: {1}".format(self.model_checkpoint, self.quantization_report))
+        self.logger.info("MED inference backend for checkpoint {0}: {1}".format(self.model_checkpoint, self.backend_report))
         self.logger.info("MED model loaded successfully. Used checkpoint: {0}".format(model_path))
 
     """
@@ -32,30 +85,112 @@ class EventDetector:
        - bytes: the audio bytes to detect events in
        - send_update_to_client: a function to send updates to the client. (float progress, string message)
        - abort_signal: a signal to abort the detection.
+    Windows are pushed through the model `batch_size` at a time, the abort signal and
+    progress updates are checked at batch boundaries.
     Returns a list of detected events.
     """
     def detect(self, signal: torch.FloatTensor, send_update_to_client, abort_signal=threading.Event()) -> DetectedEvents:
-        # Dict maps batch index to prediction
-        signal = signal.to(self.device) 
-        predictions : dict= {}
-        for batch_index, signal_window in enumerate(signal):
+        return self.detect_windows(*self.window_predictor(signal), send_update_to_client, abort_signal)
+
+    # Returns the number of windows and a function predicting windows [start, end), for callers that schedule the batches themselves.
+    def window_predictor(self, windows: torch.FloatTensor) -> tuple[int, Callable[[int, int], torch.Tensor]]:
+        windows = windows.to(self.device)
+        return windows.shape[0], lambda start, end: self.predict(windows[start:end])
+
+    """
+    Detects events in overlapping windows of a whole recording, computing the STFT only once.
+       - signal: the whole recording, shape (n) or (1, n)
+       - window_length / step_length: window size and step in samples, as used by RecordingStorage
+    The spectrogram of the recording is computed once (with the same center padding at the recording
+    edges) and every window gets its slice of frames, instead of going through the STFT once per
+    overlapping window. Produces the same windows as `detect` on signal.unfold(-1, window_length, step_length).
+
+    Tolerance: a window's frames whose FFT frame reaches past the window edge (the first and last
+    n_fft / (2 * hop) = 4 of the 121 frames of a 15360 sample window) see the neighbouring audio instead
+    of the window's own reflect padding. All other frames are identical, so probabilities differ from
+    `detect` by at most SHARED_STFT_TOLERANCE, and the events found must be the same, checked per checkpoint with
+    testing/med_shared_stft_test.py (`shared_stft_verified`).
+    """
+    def detect_signal(self, signal: torch.FloatTensor, window_length: int, step_length: int, send_update_to_client, abort_signal=threading.Event()) -> DetectedEvents:
+        return self.detect_windows(*self.signal_predictor(signal, window_length, step_length), send_update_to_client, abort_signal)
+
+    # Same as window_predictor for the windows detect_signal cuts from a whole recording.
+    def signal_predictor(self, signal: torch.FloatTensor, window_length: int, step_length: int) -> tuple[int, Callable[[int, int], torch.Tensor]]:
+        stft = self.module.inference_spec_layer
+        signal = signal.reshape(-1).to(self.device)
+        if step_length % stft.hop_length or window_length % stft.hop_length:
+            # Windows that do not start on a frame boundary cannot share frames
+            return self.window_predictor(signal.unfold(0, window_length, step_length))
+
+        total = (signal.shape[0] - window_length) // step_length + 1
+        frames_per_window = window_length // stft.hop_length + 1
+        frame_step = step_length // stft.hop_length
+        padded = F.pad(signal.view(1, 1, -1), (stft.pad_amount, stft.pad_amount), mode=stft.pad_mode).view(-1)
+
+        def predict_windows(start: int, end: int) -> torch.Tensor:
+            # Frames of windows [start, end) only, so memory stays bounded by the batch size
+            segment = padded[start * step_length:(end - 1) * step_length + window_length + stft.n_fft]
+            spec = stft(segment, center=False)  # (1, F, T)
+            windows = spec.unfold(-1, frames_per_window, frame_step)[0].transpose(0, 1).contiguous()  # (B, F, frames_per_window)
+            with torch.no_grad():
+                return F.softmax(self.module.forward_spectrogram(windows)['prediction'], dim=1)
+
+        return total, predict_windows
+
+    def detect_windows(self, total: int, predict_windows: Callable[[int, int], torch.Tensor], send_update_to_client, abort_signal) -> DetectedEvents:
+        probabilities: list[np.ndarray] = []
+        for start in range(0, total, self.batch_size):
             if abort_signal and abort_signal.is_set():
                 self.logger.info("Classification cancelled.")
                 raise UserCancelledError()
-            predictions[batch_index] = self.classify_batch(signal_window)
-            send_update_to_client( batch_index / signal.shape[0] * 100, f"Batch {batch_index + 1} of {signal.shape[0]} has been classified.")
+            end = min(start + self.batch_size, total)
+            probabilities.append(predict_windows(start, end).cpu().numpy().astype(np.float64))
+            send_update_to_client((end - 1) / total * 100, f"Batch {end} of {total} has been classified.")
 
-        self.logger.debug("Classification finished. Results: {0}".format(predictions))
+        predictions_array = np.concatenate(probabilities) if probabilities else np.empty((0, 2))
+        self.logger.debug("Classification finished. Results: {0}".format(predictions_array))
 
-        predictions_array = np.array([[pred["0"], pred["1"]] for _, pred in predictions.items()])
         send_update_to_client(100, "Classification finished.")
         return DetectedEvents(predictions_array, self.model_checkpoint)
 
+    # Shares forwards with other threads calling predict, see lib/batching.py.
+    def enable_micro_batching(self, max_batch_size: int, max_wait_ms: float, initializer: Callable[[], None] | None = None):
+        self.batcher = MicroBatcher(self.run_forward, max_batch_size, max_wait_ms, name="MEDBatcher", initializer=initializer)
 
-    def classify_batch(self, batch_bytes: torch.FloatTensor):
+    # Returns the softmax probabilities of every window in the batch, shape (B, 2).
+    def predict(self, batch_bytes: torch.FloatTensor) -> torch.Tensor:
+        if self.batcher is not None:
+            return self.batcher.predict(batch_bytes)
+        return self.run_forward(batch_bytes)
+
+    # Runs forwards in worker processes instead of this one, see lib/process_pool.py.
+    def enable_process_pool(self, process_pool: InferenceProcessPool):
+        process_pool_fallback(self.module, self.backend_report)
+        self.process_pool = process_pool
+
+    def run_forward(self, batch_bytes: torch.FloatTensor) -> torch.Tensor:
+        if self.process_pool is not None:
+            return self.process_pool.predict("med", batch_bytes)
+        return self.forward(batch_bytes)
+
+    # Bytes of the loaded weights and buffers, int8 packed weights included.
+    def resident_bytes(self) -> int:
+        return parameter_bytes(self.module) + sum(buffer.numel() * buffer.element_size() for buffer in self.module.buffers())
+
+    # Stops the batcher thread and the worker processes, the model cannot be used afterwards.
+    def close(self):
+        if self.batcher is not None:
+            self.batcher.shutdown()
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+
+    def forward(self, batch_bytes: torch.FloatTensor) -> torch.Tensor:
         with torch.no_grad():
             results = self.model(batch_bytes)['prediction']
-            softmax = F.softmax(results, dim=1)
+            return F.softmax(results, dim=1)
+
+    def classify_batch(self, batch_bytes: torch.FloatTensor):
+        softmax = self.predict(batch_bytes)
         probs, classes = torch.topk(softmax, 2, dim=1)
         probs = probs.tolist()
         classes = classes.tolist()
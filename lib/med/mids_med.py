@@ -7,6 +7,8 @@ import torchaudio.transforms as AT
 import torchvision.transforms as VT
 from nnAudio import features
 
+from lib.frontend import FusedPostFrontend, InferenceSTFT, pcen_smooth
+
 logger = logging.getLogger(__name__)
 
 class MidsMEDModel(nn.Module):
@@ -29,6 +31,16 @@ class MidsMEDModel(nn.Module):
 
 
         def pcen(self, x, eps=1e-6, s=0.025, alpha=0.98, delta=2, r=0.5, training=False):
+            if training:
+                M = self.smooth(x, s)
+                pcen_ = (x / (M + eps).pow(alpha) + delta).pow(r) - delta ** r
+            else:
+                # Same smoother as a single matmul, with s taken from the loaded checkpoint
+                M = pcen_smooth(x, s)
+                pcen_ = x.div_(M.add_(eps).pow_(alpha)).add_(delta).pow_(r).sub_(delta ** r)
+            return pcen_
+
+        def smooth(self, x, s):
             frames = x.split(1, -2)
             m_frames = []
             last_state = None
@@ -37,18 +49,10 @@ class MidsMEDModel(nn.Module):
                     last_state = s * frame
                     m_frames.append(last_state)
                     continue
-                if training:
-                    m_frame = ((1 - s) * last_state).add_(s * frame)
-                else:
-                    m_frame = (1 - s) * last_state + s * frame
+                m_frame = ((1 - s) * last_state).add_(s * frame)
                 last_state = m_frame
                 m_frames.append(m_frame)
-            M = torch.cat(m_frames, 1)
-            if training:
-                pcen_ = (x / (M + eps).pow(alpha) + delta).pow(r) - delta ** r
-            else:
-                pcen_ = x.div_(M.add_(eps).pow_(alpha)).add_(delta).pow_(r).sub_(delta ** r)
-            return pcen_
+            return torch.cat(m_frames, 1)
 
         def forward(self, x):
     #         x = x.permute((0,2,1)).squeeze(dim=1)
@@ -77,8 +81,36 @@ class MidsMEDModel(nn.Module):
                            sr=8000, output_format="Magnitude", trainable=True, fmin=300, fmax=3000,)
         self.sizer = VT.Resize((image_size,image_size))
         self.pcen_layer = self.PCENTransform(eps=1e-6, s=0.025, alpha=0.6, delta=0.1, r=0.2, trainable=True)
+        # Set by prepare_for_inference once the checkpoint is loaded
+        self.inference_spec_layer = None
+        self.fused_frontend = None
+        self.image_size = image_size
+        # Compiled / exported backbone set by lib.backends.apply_backend, `backbone` stays the eager module
+        self.backbone_runner = None
         #self.augment_layer = augment_audio(trainable = True, sample_rate = config.rate)
 
+    # Replaces the conv STFT by an FFT based one at inference when the loaded kernels are still plain
+    # Hann windowed Fourier bases, and the normalize / resize / zero check chain by a fused module.
+    # Call after loading the checkpoint, returns the STFT parity report.
+    def prepare_for_inference(self) -> dict:
+        self.inference_spec_layer = InferenceSTFT(self.spec_layer)
+        self.fused_frontend = FusedPostFrontend(self.sizer)
+        return self.inference_spec_layer.report
+
+    # Kept out of the module tree, so state_dict, share_memory and DataParallel only see the eager backbone.
+    def set_backbone_runner(self, runner):
+        self.__dict__["backbone_runner"] = runner
+
+    def run_backbone(self, x):
+        if self.backbone_runner is not None and not self.training:
+            return self.backbone_runner(x)
+        return self.backbone(x)
+
+    def spectrogram(self, x):
+        if self.inference_spec_layer is not None and not self.training:
+            return self.inference_spec_layer(x)
+        return self.spec_layer(x)
+
     def normalize(self, x):
         size = x.shape
         x_max = x.max(1, keepdim=True)[0] # Finding max values for each frame
@@ -87,31 +119,44 @@ class MidsMEDModel(nn.Module):
         output[torch.isnan(output)]=0 # Making nan to 0
         return output
 
+    # Normalizes the PCEN output and sizes it for the backbone, returns the backbone input and the resized spectrogram
+    def resize_for_backbone(self, spec):
+        spec = self.normalize(spec)
+
+        # then size for CNN model
+        # and create a channel
+        spec = self.sizer(spec)
+        x = spec.unsqueeze(1)
+        # Checked per window so a batch gives the same result as one window at a time
+        zero_inputs = torch.sum(x, dim=(1, 2, 3)) == 0
+        if torch.any(zero_inputs):
+            logging.warn("ZERO INPUT in forward")
+            x  = x+zero_inputs.view(-1, 1, 1, 1)*torch.tensor(1e-6)
+        return x, spec
+
     def forward(self, x):
         # first compute spectrogram
         logging.debug("input shape that goes for augmentation = " + str(x.squeeze().shape))
         #spec = self.augment_layer(x.squeeze())
         logging.debug("Out put of augment and input shape that goes for STFT = " + str(x.shape))
-        spec = self.spec_layer(x)  # (B, F, T)
+        spec = self.spectrogram(x)  # (B, F, T)
+        return self.forward_spectrogram(spec)
+
+    # Runs the model from the STFT magnitudes (B, F, T) onwards, so a spectrogram computed once
+    # for a whole recording can be sliced into windows.
+    def forward_spectrogram(self, spec):
         # normalize
 #         spec = spec.transpose(1,2) # (B, T, F)
         logging.debug("Out put of STFT and input shape that goes for PCEN = " + str(spec.shape))
         spec = self.pcen_layer(spec)
         logging.debug("Out put of PCEN and input shape that goes for NORM = " + str(spec.shape))
-        spec = self.normalize(spec)
-
-        # then size for CNN model
-        # and create a channel
-        spec = self.sizer(spec)
-        x = spec.unsqueeze(1)
-        # then repeat channels
+        if self.fused_frontend is not None and not self.training:
+            x, spec = self.fused_frontend(spec)
+        else:
+            x, spec = self.resize_for_backbone(spec)
         logging.debug("Final shape that goes to backbone = " + str(x.shape))
-        if torch.sum(x) == 0:
-            logging.warn("ZERO INPUT in forward")
-            x  = x+torch.tensor(1e-6)
-
 
-        x = self.backbone(x)
+        x = self.run_backbone(x)
         #print("x shape = " + str(x.shape))
         #print("x = " +str(x))
         #pred = nn.Softmax(x)
@@ -0,0 +1,112 @@
+from collections import deque
+from typing import Callable
+
+import numpy as np
+import torch
+
+from lib.config import Config
+from lib.med.event_detector import EventDetector
+from lib.utils import ensure_minimum_length
+
+# Number of consecutive windows averaged before thresholding, as DetectedEvents.get_data_frame does.
+SMOOTHING_WINDOWS = 3
+
+
+"""
+Runs MED on a continuous stream of audio, one config.min_length window at a time.
+   - push(samples): adds samples at config.sample_rate, classifies every window they complete.
+   - finish(): classifies the remaining partial window (padded with its mean, like `prepare`) and closes any open event.
+Both return the messages to send to the client, in order:
+   - {"type": "window", ...} with the probabilities of each classified window.
+   - {"type": "event_open", ...} / {"type": "event_close", ...} for contiguous regions where the mean over
+     SMOOTHING_WINDOWS windows is above config.det_threshold, with the same fields as the rows of
+     DetectedEvents.get_data_frame. A window's mean is only known once the next two windows have arrived.
+Unlike get_data_frame, which drops the last windows of a clip, the stream thresholds every window that has
+a full mean. Memory stays bounded: one window of samples and the last SMOOTHING_WINDOWS probabilities.
+`release` runs once on `close()`, e.g. to return the caller's lease on the event detector.
+"""
+class StreamingEventDetector:
+    def __init__(self, event_detector: EventDetector, config: Config = Config.default(), release: Callable[[], None] | None = None):
+        self.event_detector = event_detector
+        self._release = release
+        self.config = config
+        self.window_length = int(config.sample_rate * config.min_length)
+        self.window = np.zeros(self.window_length, dtype=np.float32)
+        self.filled = 0
+        self.windows_classified = 0
+        self.recent = deque(maxlen=SMOOTHING_WINDOWS)
+        self.smoothed_count = 0
+        self.open_event_start: int | None = None
+        self.open_event_probability_sum = 0.0
+
+    def push(self, samples: np.ndarray) -> list[dict]:
+        completed: list[np.ndarray] = []
+        offset = 0
+        while offset < len(samples):
+            count = min(self.window_length - self.filled, len(samples) - offset)
+            self.window[self.filled:self.filled + count] = samples[offset:offset + count]
+            self.filled += count
+            offset += count
+            if self.filled == self.window_length:
+                completed.append(self.window.copy())
+                self.filled = 0
+        return self._classify(completed)
+
+    def finish(self) -> list[dict]:
+        messages = []
+        if self.filled > 0:
+            messages += self._classify([ensure_minimum_length(self.window[:self.filled], self.config).astype(np.float32)])
+            self.filled = 0
+        if self.open_event_start is not None:
+            messages.append(self._close_event(self.smoothed_count))
+        return messages
+
+    def close(self):
+        release, self._release = self._release, None
+        if release is not None:
+            release()
+
+    def _classify(self, windows: list[np.ndarray]) -> list[dict]:
+        messages = []
+        batch_size = self.event_detector.batch_size
+        for start in range(0, len(windows), batch_size):
+            batch = torch.from_numpy(np.stack(windows[start:start + batch_size])).to(self.event_detector.device)
+            for probabilities in self.event_detector.predict(batch).cpu().numpy().astype(np.float64):
+                messages += self._add_window(probabilities)
+        return messages
+
+    def _add_window(self, probabilities: np.ndarray) -> list[dict]:
+        index = self.windows_classified
+        self.windows_classified += 1
+        messages = [{"type": "window", "data": {
+            "index": index,
+            "start": round(index * self.config.min_length, 2),
+            "end": round((index + 1) * self.config.min_length, 2),
+            "predictions": probabilities.tolist(),
+        }}]
+
+        self.recent.append(probabilities)
+        if len(self.recent) < SMOOTHING_WINDOWS:
+            return messages
+
+        smoothed_index = self.smoothed_count
+        self.smoothed_count += 1
+        probability = np.mean(self.recent, axis=0)[1]
+        if probability > self.config.det_threshold:
+            if self.open_event_start is None:
+                self.open_event_start = smoothed_index
+                self.open_event_probability_sum = 0.0
+                messages.append({"type": "event_open", "data": {"med_start_time": str(round(smoothed_index * self.config.min_length, 2))}})
+            self.open_event_probability_sum += probability
+        elif self.open_event_start is not None:
+            messages.append(self._close_event(smoothed_index))
+        return messages
+
+    def _close_event(self, stop: int) -> dict:
+        start = self.open_event_start
+        self.open_event_start = None
+        return {"type": "event_close", "data": {
+            "med_start_time": str(round(start * self.config.min_length, 2)),
+            "med_stop_time": str(round(stop * self.config.min_length, 2)),
+            "med_prob": "{:.4f}".format(self.open_event_probability_sum / (stop - start)),
+        }}
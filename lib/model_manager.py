@@ -0,0 +1,196 @@
+import gc
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+# Number of recent load / evict events `stats()` reports.
+EVENT_HISTORY = 64
+
+
+class _ManagedModel:
+    def __init__(self, name: str, load: Callable[[], Any], unload: Callable[[Any], None] | None, size: Callable[[Any], int], expected_bytes: int):
+        self.name = name
+        self.load = load
+        self.unload = unload
+        self.size = size
+        # Measured at the last load, until then the caller's estimate (e.g. the checkpoint size)
+        self.expected_bytes = expected_bytes
+        self.model = None
+        self.bytes = 0
+        self.loading = False
+        self.leases = 0
+        self.last_used = time.monotonic()
+        self.loads = 0
+        self.evictions = 0
+        self.load_seconds: float | None = None
+
+
+"""
+Loads models on first use and keeps their resident bytes within a budget.
+   - budget_bytes: bytes the loaded models may take together, 0 for no budget (MODEL_MEMORY_BUDGET).
+   - idle_ttl: seconds a model nobody uses stays loaded, 0 keeps it until it is evicted for the budget (MODEL_IDLE_TTL).
+Models are registered with a function loading them, one releasing what they hold besides their weights (batcher
+threads, worker processes) and one measuring their bytes. Callers hold a lease while they use a model, with
+`with manager.lease(name) as model` or `acquire` / `release` for uses spanning several calls, and a leased model
+is never evicted. Before a model is loaded the least recently used models without leases are evicted until it
+fits the budget; when the leased models alone leave no room it is loaded anyway, over budget, with a warning.
+Callers asking for a model that is loading wait for that load instead of starting another. Every load and
+eviction is logged and reported by `stats()`, with the seconds the load kept its callers waiting.
+"""
+class ModelManager:
+    def __init__(self, budget_bytes: int = 0, idle_ttl: float = 0):
+        self.logger = logging.getLogger('ModelManager')
+        self.budget_bytes = budget_bytes
+        self.idle_ttl = idle_ttl
+        self._models: dict[str, _ManagedModel] = {}
+        self._condition = threading.Condition()
+        self._events: deque[dict] = deque(maxlen=EVENT_HISTORY)
+        self._stopped = threading.Event()
+        if idle_ttl > 0:
+            threading.Thread(target=self._evict_idle, name="ModelEvictor", daemon=True).start()
+
+    def register(self, name: str, load: Callable[[], Any], unload: Callable[[Any], None] | None = None, size: Callable[[Any], int] = lambda _: 0, expected_bytes: int = 0):
+        with self._condition:
+            self._models[name] = _ManagedModel(name, load, unload, size, expected_bytes)
+
+    @contextmanager
+    def lease(self, name: str) -> Iterator[Any]:
+        model = self.acquire(name)
+        try:
+            yield model
+        finally:
+            self.release(name)
+
+    # Returns the model, loading it first if needed. Every acquire must be followed by a release.
+    def acquire(self, name: str) -> Any:
+        with self._condition:
+            entry = self._models[name]
+            while entry.loading:
+                self._condition.wait()
+            entry.leases += 1
+            if entry.model is not None:
+                return entry.model
+            entry.loading = True
+            evicted = self._make_room(entry)
+        self._unload(evicted, "budget")
+
+        started = time.perf_counter()
+        try:
+            model = entry.load()
+            size = entry.size(model)
+        except Exception:
+            with self._condition:
+                entry.loading = False
+                entry.leases -= 1
+                self._condition.notify_all()
+            raise
+        seconds = time.perf_counter() - started
+
+        with self._condition:
+            entry.model = model
+            entry.bytes = entry.expected_bytes = size
+            entry.loading = False
+            entry.loads += 1
+            entry.load_seconds = seconds
+            resident = self._resident_bytes()
+            self._record({"event": "load", "model": name, "seconds": round(seconds, 3), "bytes": size, "resident_bytes": resident})
+            self._condition.notify_all()
+        self.logger.info("Loaded {0} ({1:.1f} MB) in {2:.1f}s, {3:.1f} MB resident".format(name, size / 2**20, seconds, resident / 2**20))
+        if 0 < self.budget_bytes < resident:
+            self.logger.warning("Models in use take {0:.1f} MB, over the budget of {1:.1f} MB".format(resident / 2**20, self.budget_bytes / 2**20))
+        return model
+
+    def release(self, name: str):
+        with self._condition:
+            entry = self._models[name]
+            entry.leases -= 1
+            entry.last_used = time.monotonic()
+
+    # The model if it is loaded, without a lease or loading it, e.g. for metrics.
+    def peek(self, name: str) -> Any:
+        with self._condition:
+            return self._models[name].model
+
+    def _resident_bytes(self) -> int:
+        return sum(entry.bytes if entry.model is not None else entry.expected_bytes if entry.loading else 0 for entry in self._models.values())
+
+    # Called with the lock held: takes the least recently used unleased models until `entry` fits the budget.
+    def _make_room(self, entry: _ManagedModel) -> list[tuple[_ManagedModel, Any, int]]:
+        if self.budget_bytes <= 0:
+            return []
+        candidates = sorted((other for other in self._models.values() if other.model is not None and other.leases == 0), key=lambda other: other.last_used)
+        evicted = []
+        # The resident bytes already count the expected bytes of `entry`, it is marked as loading
+        while candidates and self._resident_bytes() > self.budget_bytes:
+            evicted.append(self._take(candidates.pop(0)))
+        return evicted
+
+    def _take(self, entry: _ManagedModel) -> tuple[_ManagedModel, Any, int]:
+        model, size = entry.model, entry.bytes
+        entry.model = None
+        entry.bytes = 0
+        return entry, model, size
+
+    def _unload(self, evicted: list[tuple[_ManagedModel, Any, int]], reason: str):
+        for entry, model, size in evicted:
+            idle_seconds = time.monotonic() - entry.last_used
+            started = time.perf_counter()
+            if entry.unload is not None:
+                try:
+                    entry.unload(model)
+                except Exception:
+                    self.logger.exception("Unloading {0} failed".format(entry.name))
+            del model
+            # Drops reference cycles still holding the weights
+            gc.collect()
+            seconds = time.perf_counter() - started
+            with self._condition:
+                entry.evictions += 1
+                resident = self._resident_bytes()
+                self._record({"event": "evict", "model": entry.name, "reason": reason, "seconds": round(seconds, 3), "bytes": size, "idle_seconds": round(idle_seconds, 1), "resident_bytes": resident})
+            self.logger.info("Evicted {0} ({1:.1f} MB, {2}, idle for {3:.0f}s), {4:.1f} MB resident".format(entry.name, size / 2**20, reason, idle_seconds, resident / 2**20))
+
+    def _evict_idle(self):
+        while not self._stopped.wait(max(1.0, self.idle_ttl / 4)):
+            now = time.monotonic()
+            with self._condition:
+                evicted = [
+                    self._take(entry) for entry in self._models.values()
+                    if entry.model is not None and entry.leases == 0 and now - entry.last_used >= self.idle_ttl
+                ]
+            self._unload(evicted, "idle")
+
+    def _record(self, event: dict):
+        self._events.append({"time": round(time.time(), 3), **event})
+
+    def shutdown(self):
+        self._stopped.set()
+        with self._condition:
+            evicted = [self._take(entry) for entry in self._models.values() if entry.model is not None]
+        self._unload(evicted, "shutdown")
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._condition:
+            return {
+                "budget_bytes": self.budget_bytes,
+                "idle_ttl": self.idle_ttl,
+                "resident_bytes": self._resident_bytes(),
+                "models": {
+                    name: {
+                        "loaded": entry.model is not None,
+                        "loading": entry.loading,
+                        "bytes": entry.bytes,
+                        "leases": entry.leases,
+                        "idle_seconds": round(now - entry.last_used, 1) if entry.model is not None and entry.leases == 0 else None,
+                        "loads": entry.loads,
+                        "evictions": entry.evictions,
+                        "last_load_seconds": entry.load_seconds,
+                    }
+                    for name, entry in self._models.items()
+                },
+                "events": list(self._events),
+            }
@@ -1,15 +1,22 @@
 import logging
 import threading
+from typing import Callable
 
 import numpy as np
 import torch
 import torch.nn.functional as F
 
 from lib.config import Config
+from lib.backends import apply_backend, process_pool_fallback
+from lib.batching import MicroBatcher
+from lib.checkpoints import load_model
 from lib.custom_types import (DetectedEvents, DetectedSpecies,
                               SpeciesClassificationResponse)
 from lib.exceptions import UserCancelledError
 from lib.msc.mids_msc import MidsMSCModel
+from lib.process_pool import InferenceProcessPool
+from lib.quantization import parameter_bytes, quantize_backbone
+from lib.runtime import wrap_model
 
 mapping: dict  = {
  "0":"an arabiensis",
@@ -28,22 +35,33 @@ To use the Species Classifier, you need to do the following steps:
 1. Given raw audio bytes, 
 """
 class SpeciesClassifier: 
-    model: MidsMSCModel
+    # The loaded model, and the one forwards go through: the same module unless it is spread over several GPUs
+    module: MidsMSCModel
+    model: torch.nn.Module
     model_checkpoint: str
 
-    def __init__(self, model_path: str):
+    def __init__(self, model_path: str, batch_size: int = 1, backend: str = "eager", quantization: str = "none", precision: str = "fp32"):
         self.logger = logging.getLogger('SpeciesClassifier')
+        self.batch_size = max(1, batch_size)
+        self.batcher: MicroBatcher | None = None
+        self.process_pool: InferenceProcessPool | None = None
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'mps' if torch.backends.mps.is_available() else 'cpu')
 
 
-        model = MidsMSCModel()
         print("Loading MSC model from {0}".format(model_path))
-        model.load_state_dict(torch.load(model_path, map_location=self.device))
+        # Training or inference checkpoint (lib/checkpoints.py), memory mapped when possible
+        model = load_model(MidsMSCModel, model_path, self.device)
         model.eval()
-        self.model = model
-        self.model = torch.nn.DataParallel(model).to(self.device)
+        self.frontend_report = model.prepare_for_inference()
+        self.quantization_report = quantize_backbone(model, quantization)
+        self.backend_report = apply_backend(model, backend, model_path, self.batch_size, precision)
+        self.module = model
+        self.model = wrap_model(model, self.device)
 
         self.model_checkpoint = model_path.split("/")[-1]
+        self.logger.info("MSC STFT frontend for checkpoint {0}: {1}".format(self.model_checkpoint, self.frontend_report))
+        self.logger.info("MSC quantization for checkpoint {0}: {1}".format(self.model_checkpoint, self.quantization_report))
+        self.logger.info("MSC inference backend for checkpoint {0}: {1}".format(self.model_checkpoint, self.backend_report))
         self.logger.info("MSC model loaded successfully. Used checkpoint: {0}".format(model_path))
 
     
@@ -51,13 +69,16 @@ class SpeciesClassifier:
         events_audio = events_audio.to(self.device)
         # Batch index to species predictions which is dict of species to probabilities
         predictions : dict[int,dict[str,float]] = {}
-        for batch_index, signal_window in enumerate(events_audio):
+        total = events_audio.shape[0]
+        for start in range(0, total, self.batch_size):
             if abort_signal and abort_signal.is_set():
                 self.logger.info("Classification cancelled.")
                 raise UserCancelledError()
-            
-            predictions[batch_index] = self.classify_batch(signal_window)
-            send_update_to_client( batch_index / events_audio.shape[0] * 100, f"Batch {batch_index + 1} of {events_audio.shape[0]} has been classified.")
+
+            end = min(start + self.batch_size, total)
+            for batch_index, window_predictions in enumerate(self.classify_windows(events_audio[start:end]), start=start):
+                predictions[batch_index] = window_predictions
+            send_update_to_client( (end - 1) / total * 100, f"Batch {end} of {total} has been classified.")
             
         send_update_to_client(100, "Classification finished.")
         
@@ -70,12 +91,48 @@ class SpeciesClassifier:
         )
 
     
-    def classify_batch(self, batch_bytes: torch.FloatTensor):
-        with torch.no_grad():
+    # Shares forwards with other threads calling predict, see lib/batching.py.
+    def enable_micro_batching(self, max_batch_size: int, max_wait_ms: float, initializer: Callable[[], None] | None = None):
+        self.batcher = MicroBatcher(self.run_forward, max_batch_size, max_wait_ms, name="MSCBatcher", initializer=initializer)
+
+    # Returns the softmax probabilities of every window in the batch, shape (B, 8).
+    def predict(self, batch_bytes: torch.FloatTensor) -> torch.Tensor:
+        if self.batcher is not None:
+            return self.batcher.predict(batch_bytes)
+        return self.run_forward(batch_bytes)
+
+    # Runs forwards in worker processes instead of this one, see lib/process_pool.py.
+    def enable_process_pool(self, process_pool: InferenceProcessPool):
+        process_pool_fallback(self.module, self.backend_report)
+        self.process_pool = process_pool
+
+    def run_forward(self, batch_bytes: torch.FloatTensor) -> torch.Tensor:
+        if self.process_pool is not None:
+            return self.process_pool.predict("msc", batch_bytes)
+        return self.forward(batch_bytes)
 
+    # Bytes of the loaded weights and buffers, int8 packed weights included.
+    def resident_bytes(self) -> int:
+        return parameter_bytes(self.module) + sum(buffer.numel() * buffer.element_size() for buffer in self.module.buffers())
+
+    # Stops the batcher thread and the worker processes, the model cannot be used afterwards.
+    def close(self):
+        if self.batcher is not None:
+            self.batcher.shutdown()
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+
+    def forward(self, batch_bytes: torch.FloatTensor) -> torch.Tensor:
+        with torch.no_grad():
             results = self.model(batch_bytes)['prediction']
-            softmax = F.softmax(results, dim=1)
-            
+            return F.softmax(results, dim=1)
+
+    def classify_batch(self, batch_bytes: torch.FloatTensor):
+        return self.classify_windows(batch_bytes)[0]
+
+    # Classifies every window of the batch in a single forward, returning one dict of species to probability per window.
+    def classify_windows(self, batch_bytes: torch.FloatTensor) -> list[dict[str, float]]:
+        softmax = self.predict(batch_bytes)
         probs, classes = torch.topk(softmax, 8, dim=1)
         probs = probs.tolist()
         classes = classes.tolist()
@@ -88,5 +145,5 @@ class SpeciesClassifier:
             for row in zip(classes, probs)
         ]
 
-        return results[0]
+        return results
     
\ No newline at end of file
@@ -0,0 +1,48 @@
+from typing import Callable
+
+import torch
+import torch.nn as nn
+
+# Values of PRECISION.
+PRECISIONS = ("fp32", "bf16")
+
+# Max absolute difference in backbone logits accepted from a bf16 backbone, its mantissa has 8 bits.
+BF16_PARITY_TOLERANCE = 0.1
+
+
+def bf16_supported() -> bool:
+    """Whether oneDNN has fast bfloat16 kernels on this CPU (AVX-512 BF16 or AMX), emulated bf16 is slower than fp32."""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def resolve_precision(requested: str, model: nn.Module, backend: str) -> tuple[str, str | None]:
+    """Returns the precision the backbone of `model` can run in and why it differs from `requested`, if it does."""
+    if requested not in PRECISIONS:
+        raise ValueError("Unknown precision {0}, expected one of {1}".format(requested, ", ".join(PRECISIONS)))
+    if requested == "fp32":
+        return "fp32", None
+    if next(model.backbone.parameters()).device.type != "cpu":
+        return "fp32", "bf16 autocast is only set up for CPU inference"
+    if not bf16_supported():
+        return "fp32", "the CPU has no bf16 support (AVX-512 BF16 / AMX)"
+    if getattr(model, "quantization", "none") != "none":
+        return "fp32", "the quantized backbone takes fp32 inputs"
+    if backend == "onnx":
+        return "fp32", "the ONNX backbone runs in fp32"
+    return requested, None
+
+
+class BFloat16Backbone:
+    """Runs a channels_last backbone under CPU autocast to bfloat16 and returns fp32 logits, called like the backbone.
+
+    Only the backbone is wrapped, the STFT / PCEN frontend before it keeps running in fp32."""
+
+    def __init__(self, backbone: Callable[[torch.Tensor], torch.Tensor]):
+        self.backbone = backbone
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            return self.backbone(x.contiguous(memory_format=torch.channels_last)).float()
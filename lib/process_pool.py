@@ -0,0 +1,227 @@
+import io
+import itertools
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import torch.nn as nn
+import torch.nn.functional as F
+
+from lib.checkpoints import load_model
+from lib.quantization import quantize_backbone
+
+
+class _SharedBuffers:
+    """Reusable shared memory blocks for the windows of in-flight requests.
+
+    Blocks are sized in powers of two and handed back after the worker has read them, so steady traffic
+    reuses the same few blocks instead of creating and unlinking shared memory per request."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._free: list[shared_memory.SharedMemory] = []
+        self._all: list[shared_memory.SharedMemory] = []
+
+    def acquire(self, nbytes: int) -> shared_memory.SharedMemory:
+        with self._lock:
+            fitting = [block for block in self._free if block.size >= nbytes]
+            if fitting:
+                block = min(fitting, key=lambda block: block.size)
+                self._free.remove(block)
+                return block
+            block = shared_memory.SharedMemory(create=True, size=1 << max(12, (nbytes - 1).bit_length()))
+            self._all.append(block)
+            return block
+
+    def release(self, block: shared_memory.SharedMemory):
+        with self._lock:
+            self._free.append(block)
+
+    def close(self):
+        with self._lock:
+            for block in self._all:
+                block.close()
+                block.unlink()
+            self._all.clear()
+            self._free.clear()
+
+
+def _softmax_forward(model: nn.Module, windows: torch.Tensor) -> torch.Tensor:
+    with torch.no_grad():
+        return F.softmax(model(windows)['prediction'], dim=1)
+
+
+def _worker_main(index: int, models: dict[str, tuple[type, str | None, dict | None, bytes | None, str]], tasks, results, threads: int):
+    torch.set_num_threads(threads)
+    loaded = {}
+    for name, (model_class, checkpoint, state_dict, packed, quantization) in models.items():
+        if checkpoint is not None:
+            # Memory maps the parent's inference checkpoint, its pages are shared through the page cache
+            model = load_model(model_class, checkpoint)
+            quantize_backbone(model.eval(), quantization)
+        else:
+            model = model_class()
+            # The quantized modules have to exist before their packed weights can be loaded into them
+            quantize_backbone(model.eval(), quantization)
+            state_dict.update(torch.load(io.BytesIO(packed)))
+            # assign=True keeps the parent's shared memory tensors as parameters instead of copying them
+            model.load_state_dict(state_dict, assign=True)
+        model.prepare_for_inference()
+        loaded[name] = model
+    results.put(("ready", index, None))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        request_id, name, buffer_name, shape = task
+        block = shared_memory.SharedMemory(name=buffer_name)
+        try:
+            windows = torch.from_numpy(np.ndarray(shape, dtype=np.float32, buffer=block.buf))
+            results.put((request_id, _softmax_forward(loaded[name], windows).numpy(), None))
+        except Exception as e:
+            results.put((request_id, None, "{0}: {1}".format(type(e).__name__, e)))
+        finally:
+            # Views of the buffer have to be gone before it can be closed
+            windows = None
+            block.close()
+
+
+"""
+Runs MED/MSC forwards in a pool of worker processes, past the GIL and the per process torch thread pool.
+   - models: name -> loaded model, e.g. {"med": MidsMEDModel, "msc": MidsMSCModel} on the CPU.
+   - processes: number of workers, each running torch with cpu_count / processes threads.
+The parent's weights are moved to shared memory and the workers build their models around the same storage,
+so the weights exist once however many workers run; models loaded from an inference checkpoint are memory
+mapped by every worker from the same file instead. Windows are copied once into a reusable shared memory
+block and read in place by the worker; only the small softmax outputs travel back through a queue.
+`predict(name, windows)` is thread safe and blocks until a free worker has run the forward.
+"""
+class InferenceProcessPool:
+    def __init__(self, models: dict[str, nn.Module], processes: int):
+        self.logger = logging.getLogger('InferenceProcessPool')
+        self.processes = max(1, processes)
+        threads = max(1, (os.cpu_count() or 1) // self.processes)
+
+        shared_models = {}
+        for name, model in models.items():
+            checkpoint = getattr(model, "inference_checkpoint", None)
+            if checkpoint is not None:
+                # Workers map the same file, moving the weights to shared memory would copy them
+                shared_models[name] = (type(model), checkpoint, None, None, getattr(model, "quantization", "none"))
+                continue
+            model.share_memory()
+            shared_models[name] = (type(model), None, *self._split_state_dict(model))
+
+        context = mp.get_context("spawn")
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._workers = [
+            context.Process(target=_worker_main, args=(index, shared_models, self._tasks, self._results, threads), name=f"inference-{index}", daemon=True)
+            for index in range(self.processes)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+        self._buffers = _SharedBuffers()
+        self._lock = threading.Lock()
+        self._pending: dict[int, tuple[Future, shared_memory.SharedMemory]] = {}
+        self._request_ids = itertools.count()
+        self._closed = False
+
+        self._wait_until_ready()
+        self.logger.info("Started {0} inference processes with {1} threads each for {2}".format(self.processes, threads, list(models)))
+
+        self._dispatcher = threading.Thread(target=self._dispatch, name="InferenceProcessPoolResults", daemon=True)
+        self._dispatcher.start()
+
+    # Quantized weights (packed int8 Linear params, see lib/quantization.py) do not survive the shared memory
+    # pickling, they are serialized and copied to every worker. Returns the shared state, the packed bytes and the quantization.
+    @staticmethod
+    def _split_state_dict(model: nn.Module) -> tuple[dict, bytes, str]:
+        state_dict = model.state_dict()
+        packed = {key: value for key, value in state_dict.items() if not isinstance(value, torch.Tensor) or value.is_quantized}
+        # Deleting keeps the state dict's _metadata, quantized modules need its versions to load
+        for key in packed:
+            del state_dict[key]
+        buffer = io.BytesIO()
+        torch.save(packed, buffer)
+        return state_dict, buffer.getvalue(), getattr(model, "quantization", "none")
+
+    def _wait_until_ready(self):
+        ready = 0
+        while ready < len(self._workers):
+            try:
+                request_id, index, _ = self._results.get(timeout=1)
+                ready += request_id == "ready"
+            except queue.Empty:
+                dead = [worker.name for worker in self._workers if not worker.is_alive()]
+                if dead:
+                    self.shutdown()
+                    raise RuntimeError("Inference workers exited while loading the models: {0}".format(dead))
+
+    def predict(self, name: str, windows: torch.Tensor) -> torch.Tensor:
+        return self.submit(name, windows).result()
+
+    def submit(self, name: str, windows: torch.Tensor) -> Future:
+        windows = windows.detach().to(device="cpu", dtype=torch.float32)
+        block = self._buffers.acquire(max(1, windows.numel() * 4))
+        np.ndarray(tuple(windows.shape), dtype=np.float32, buffer=block.buf)[...] = windows.numpy()
+
+        future = Future()
+        with self._lock:
+            if self._closed:
+                self._buffers.release(block)
+                raise RuntimeError("The inference process pool has been shut down.")
+            request_id = next(self._request_ids)
+            self._pending[request_id] = (future, block)
+        self._tasks.put((request_id, name, block.name, tuple(windows.shape)))
+        return future
+
+    def _receive(self, timeout: float):
+        request_id, output, error = self._results.get(timeout=timeout)
+        with self._lock:
+            pending = self._pending.pop(request_id, None)
+        if pending is None:
+            # Already failed by _fail_pending
+            return
+        future, block = pending
+        self._buffers.release(block)
+        if error is not None:
+            future.set_exception(RuntimeError("Inference worker failed. {0}".format(error)))
+        else:
+            future.set_result(torch.from_numpy(output))
+
+    def _dispatch(self):
+        while not self._closed:
+            try:
+                self._receive(timeout=1)
+            except queue.Empty:
+                dead = [worker.name for worker in self._workers if not worker.is_alive()]
+                if dead and not self._closed:
+                    self._fail_pending(RuntimeError("Inference workers exited: {0}".format(dead)))
+            except (EOFError, OSError):
+                return
+
+    def _fail_pending(self, error: Exception):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future, block in pending.values():
+            self._buffers.release(block)
+            future.set_exception(error)
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join(timeout=5)
+        self._fail_pending(RuntimeError("The inference process pool has been shut down."))
+        self._buffers.close()
@@ -0,0 +1,122 @@
+import argparse
+import glob
+import json
+import logging
+import os
+
+import librosa
+import numpy as np
+import torch
+import torch.nn as nn
+
+from lib.config import Config
+from lib.utils import get_audio_with_events, prepare
+
+logger = logging.getLogger(__name__)
+
+# Values of QUANTIZATION.
+QUANTIZATION_MODES = ("none", "dynamic")
+
+
+def parameter_bytes(module: nn.Module) -> int:
+    # Quantized Linear weights are packed and not parameters, their int8 size is counted from the packed tensors
+    total = sum(parameter.numel() * parameter.element_size() for parameter in module.parameters())
+    for submodule in module.modules():
+        if isinstance(submodule, torch.ao.nn.quantized.dynamic.Linear):
+            weight, bias = submodule._weight_bias()
+            total += weight.numel() * weight.element_size() + (bias.numel() * bias.element_size() if bias is not None else 0)
+    return total
+
+
+def quantize_backbone(model: nn.Module, mode: str) -> dict:
+    """Quantizes the backbone of a loaded, eval mode MED / MSC model in place.
+
+    "dynamic" stores the weights of every nn.Linear as int8 and quantizes their inputs per batch. In the timm
+    ConvNeXt blocks these are the pointwise MLP layers, which hold most of the weights and FLOPs; the depthwise,
+    stem and downsampling convolutions, the norms and the STFT frontend stay fp32 (PyTorch has no dynamic
+    quantization of convolutions). Returns the report: mode, quantized layers and backbone bytes before / after."""
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError("Unknown quantization {0}, expected one of {1}".format(mode, ", ".join(QUANTIZATION_MODES)))
+    model.quantization = mode
+    if mode == "none":
+        return {"mode": mode}
+
+    bytes_before = parameter_bytes(model.backbone)
+    layers = sum(1 for module in model.backbone.modules() if isinstance(module, nn.Linear))
+    torch.ao.quantization.quantize_dynamic(model.backbone, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return {"mode": mode, "quantized_layers": layers, "backbone_bytes": bytes_before, "quantized_backbone_bytes": parameter_bytes(model.backbone)}
+
+
+def _event_boundaries(events, config: Config) -> list[tuple[float, float]]:
+    df = events.get_data_frame(config)
+    return [(float(row["med_start_time"]), float(row["med_stop_time"])) for _, row in df.iterrows()]
+
+
+def _compare_recording(path: str, fp32: dict, int8: dict, config: Config) -> dict:
+    signal, _ = librosa.load(path, sr=config.sample_rate)
+    windows = torch.FloatTensor(prepare(signal, config))
+    events = {name: models["med"].detect(windows, lambda *_: None) for name, models in (("fp32", fp32), ("int8", int8))}
+    boundaries = {name: _event_boundaries(found, config) for name, found in events.items()}
+    report = {
+        "events": len(boundaries["fp32"]),
+        "int8_events": len(boundaries["int8"]),
+        "identical_boundaries": boundaries["fp32"] == boundaries["int8"],
+        "max_window_probability_diff": float(np.abs(events["fp32"].predictions_array - events["int8"].predictions_array).max()) if len(windows) else 0.0,
+    }
+    if len(boundaries["fp32"]) == len(boundaries["int8"]) and boundaries["fp32"]:
+        report["max_boundary_shift_seconds"] = max(
+            max(abs(start - int8_start), abs(stop - int8_stop))
+            for (start, stop), (int8_start, int8_stop) in zip(boundaries["fp32"], boundaries["int8"])
+        )
+
+    # Both MSC models classify the windows of the fp32 events, so their top-1 species can be compared one to one
+    if events["fp32"].has_events(config.det_threshold) and boundaries["fp32"]:
+        events_audio = torch.FloatTensor(get_audio_with_events(signal, events["fp32"], config))
+        species = {name: [max(window, key=window.get) for window in models["msc"].classify_windows(events_audio)] for name, models in (("fp32", fp32), ("int8", int8))}
+        report["msc_windows"] = len(species["fp32"])
+        report["msc_top1_agreement"] = float(np.mean([a == b for a, b in zip(species["fp32"], species["int8"])]))
+    return report
+
+
+def calibration_report(med_checkpoint: str, msc_checkpoint: str, paths: list[str], mode: str = "dynamic", config: Config = Config.default()) -> dict:
+    """Runs local recordings through the fp32 and the quantized models and compares MED event boundaries
+    (DetectedEvents.get_data_frame) and MSC top-1 species, per recording and in total."""
+    from lib.med.event_detector import EventDetector
+    from lib.msc.species_classifier import SpeciesClassifier
+
+    fp32 = {"med": EventDetector(med_checkpoint), "msc": SpeciesClassifier(msc_checkpoint)}
+    int8 = {"med": EventDetector(med_checkpoint, quantization=mode), "msc": SpeciesClassifier(msc_checkpoint, quantization=mode)}
+    recordings = {path: _compare_recording(path, fp32, int8, config) for path in paths}
+
+    msc_windows = sum(report.get("msc_windows", 0) for report in recordings.values())
+    summary = {
+        "mode": mode,
+        "recordings": len(recordings),
+        "recordings_with_identical_events": sum(report["identical_boundaries"] for report in recordings.values()),
+        "max_window_probability_diff": max((report["max_window_probability_diff"] for report in recordings.values()), default=0.0),
+        "msc_windows": msc_windows,
+        "msc_top1_agreement": sum(report.get("msc_top1_agreement", 0.0) * report.get("msc_windows", 0) for report in recordings.values()) / msc_windows if msc_windows else None,
+        "med_quantization": int8["med"].quantization_report,
+        "msc_quantization": int8["msc"].quantization_report,
+    }
+    return {"summary": summary, "recordings": recordings}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares MED events and MSC top-1 species of the fp32 and quantized models on local recordings.")
+    parser.add_argument("med_checkpoint")
+    parser.add_argument("msc_checkpoint")
+    parser.add_argument("recordings", nargs="+", help="audio files or directories of audio files")
+    parser.add_argument("--mode", default="dynamic", choices=QUANTIZATION_MODES[1:])
+    parser.add_argument("--output", help="also write the report to this json file")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    paths = []
+    for path in arguments.recordings:
+        paths.extend(sorted(file for file in glob.glob(os.path.join(path, "*")) if os.path.isfile(file)) if os.path.isdir(path) else [path])
+    report = json.dumps(calibration_report(arguments.med_checkpoint, arguments.msc_checkpoint, paths, arguments.mode), indent=4)
+    print(report)
+    if arguments.output:
+        with open(arguments.output, "w") as file:
+            file.write(report)
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, TypeVar
+
+import numpy as np
+
+from lib.config import Config
+
+T = TypeVar("T")
+
+# Config fields that change MED/MSC results, part of every cache key.
+CONFIG_KEY_FIELDS = ("min_length", "window_size", "step_size", "n_hop", "det_threshold", "sample_rate")
+
+
+def audio_digest(samples: np.ndarray) -> str:
+    # blake2b of the raw float32 samples, hashed in place without a copy when they are already contiguous float32
+    samples = np.ascontiguousarray(samples, dtype=np.float32)
+    return hashlib.blake2b(memoryview(samples).cast("B"), digest_size=16).hexdigest()
+
+
+# `inference`: how each model producing the result runs, e.g. {"med": {"quantization": "dynamic", "backend": "eager", "precision": "fp32"}}.
+def result_key(kind: str, samples: np.ndarray, checkpoints: list[str], config: Config, inference: dict[str, dict] | None = None) -> str:
+    fields = {field: getattr(config, field) for field in CONFIG_KEY_FIELDS}
+    description = json.dumps([kind, audio_digest(samples), checkpoints, fields, inference or {}], sort_keys=True)
+    return hashlib.blake2b(description.encode(), digest_size=16).hexdigest()
+
+
+"""
+Content addressed cache of classification results (DetectedEvents, SpeciesClassificationResponse).
+   - max_bytes: budget of the in-memory LRU tier, measured on the serialized results.
+   - directory: optional on-disk tier, every result is also written there as <key>.json and survives restarts.
+Results are stored as the JSON of their __dict__() and rebuilt with from_dict, so a cached result is never
+shared (and mutated) between callers. `stats()` reports hits and misses per tier.
+"""
+class ResultCache:
+    def __init__(self, max_bytes: int, directory: str | None = None):
+        self.logger = logging.getLogger('ResultCache')
+        self.max_bytes = max_bytes
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str, from_dict: Callable[[dict], T]) -> T | None:
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return from_dict(json.loads(data))
+
+        data = self._read_disk(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._store(key, data)
+        return from_dict(json.loads(data))
+
+    def put(self, key: str, result):
+        data = json.dumps(result.__dict__())
+        with self._lock:
+            self._store(key, data)
+        self._write_disk(key, data)
+
+    def _store(self, key: str, data: str):
+        if key in self._entries:
+            self._bytes -= len(self._entries.pop(key))
+        if len(data) > self.max_bytes:
+            return
+        self._entries[key] = data
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.evictions += 1
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _read_disk(self, key: str) -> str | None:
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key)) as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_disk(self, key: str, data: str):
+        if not self.directory:
+            return
+        # Written next to the target and renamed, readers never see a partial file
+        temporary = f"{self._path(key)}.{threading.get_ident()}.tmp"
+        try:
+            with open(temporary, "w") as file:
+                file.write(data)
+            os.replace(temporary, self._path(key))
+        except OSError as e:
+            self.logger.warning("Could not write result {0} to the disk cache: {1}".format(key, e))
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,96 @@
+import itertools
+import logging
+import os
+import threading
+from typing import TYPE_CHECKING
+
+# torch is imported on first use, the services create their topology before loading it
+if TYPE_CHECKING:
+    import torch
+    import torch.nn as nn
+
+logger = logging.getLogger(__name__)
+
+
+# DataParallel only helps with several GPUs, on one GPU or the CPU it is a per forward scatter / gather for nothing.
+def wrap_model(model: "nn.Module", device: "torch.device") -> "nn.Module":
+    import torch
+    import torch.nn as nn
+
+    model = model.to(device)
+    if device.type == "cuda" and torch.cuda.device_count() > 1:
+        return nn.DataParallel(model)
+    return model
+
+
+def _set_thread_count(threads: int):
+    import torch
+
+    # A thread's first torch call resets its OpenMP thread count to the process wide value, which other threads
+    # change. Making that call first keeps the count set here for this thread.
+    torch.get_num_threads()
+    torch.set_num_threads(threads)
+
+
+"""
+Owns how torch uses the CPU cores of a service process.
+   - workers: threads running forwards at the same time (INFERENCE_WORKERS, PIPELINE_WORKERS).
+   - threads_per_worker: intra-op threads of each worker, 0 splits the available cores evenly (TORCH_THREADS).
+   - interop_threads: size of torch's inter-op pool (TORCH_INTEROP_THREADS).
+   - pin: pins every worker thread, and the OpenMP threads it starts, to its own cores (PIN_THREADS, Linux only).
+torch's intra-op thread count is a per thread setting, so instead of every concurrent forward running on
+all cores and oversubscribing them, each worker calls `initialize_worker` when it starts and keeps to its
+share. A thread that runs the forwards of all workers (the micro-batcher) calls `initialize_shared` and
+gets every core. Call `configure` once, before the models are loaded.
+"""
+class ThreadTopology:
+    def __init__(self, workers: int = 1, threads_per_worker: int = 0, interop_threads: int = 1, pin: bool = False):
+        self.cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+        self.workers = max(1, workers)
+        self.threads_per_worker = threads_per_worker if threads_per_worker > 0 else max(1, len(self.cores) // self.workers)
+        self.interop_threads = max(1, interop_threads)
+        self.pin = pin and hasattr(os, "sched_setaffinity")
+        self._slots = itertools.count()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_environment(environment, workers: int) -> "ThreadTopology":
+        return ThreadTopology(workers, environment.torch_threads, environment.torch_interop_threads, environment.pin_threads)
+
+    # Cores of the worker in `slot`, workers beyond the available cores wrap around and share them.
+    def worker_cores(self, slot: int) -> list[int]:
+        start = (slot % self.workers) * self.threads_per_worker
+        return sorted({self.cores[(start + offset) % len(self.cores)] for offset in range(self.threads_per_worker)})
+
+    def configure(self):
+        # Also the default of threads that never call initialize_worker
+        import torch
+
+        _set_thread_count(self.threads_per_worker)
+        try:
+            torch.set_num_interop_threads(self.interop_threads)
+        except RuntimeError as e:
+            # Only possible before the inter-op pool has run anything
+            logger.warning("Could not set the inter-op threads: {0}".format(e))
+        logger.info("Thread layout: {0}".format(self.layout()))
+
+    def initialize_worker(self):
+        with self._lock:
+            slot = next(self._slots)
+        _set_thread_count(self.threads_per_worker)
+        if self.pin:
+            # 0 is the calling thread
+            os.sched_setaffinity(0, self.worker_cores(slot))
+        logger.debug("{0} runs torch on {1} threads{2}".format(threading.current_thread().name, self.threads_per_worker, ", cores {0}".format(self.worker_cores(slot)) if self.pin else ""))
+
+    def initialize_shared(self):
+        _set_thread_count(len(self.cores))
+
+    def layout(self) -> dict:
+        return {
+            "cores": len(self.cores),
+            "workers": self.workers,
+            "threads_per_worker": self.threads_per_worker,
+            "interop_threads": self.interop_threads,
+            "pinned": [self.worker_cores(slot) for slot in range(self.workers)] if self.pin else None,
+        }
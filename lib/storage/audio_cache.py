@@ -0,0 +1,152 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Callable, Iterator
+
+import numpy as np
+
+# Values of AUDIO_CACHE_DTYPE.
+AUDIO_CACHE_DTYPES = ("float32", "int16")
+
+# int16 entries hold the samples scaled like PCM16.
+INT16_SCALE = 32768
+
+
+"""
+Disk cache of decoded recordings: the mono signal at the model sample rate, as <key>.npy files.
+   - directory: where the entries are written (AUDIO_CACHE_DIR).
+   - dtype: "float32" keeps the decoded samples as they are, "int16" halves the files and rounds the samples
+     to PCM16, lossless for mono PCM16 sources at the model rate (AUDIO_CACHE_DTYPE).
+Entries are keyed by the source file's path, size and modification time, so a replaced file is decoded again.
+Hits are memory mapped (np.load(mmap_mode="r")): a recording read again, for another threshold or an MSC
+pass, is neither decoded nor loaded into memory, only the pages read are. Misses are written while the
+recording is decoded, to a temporary file renamed once it is complete, so readers never see a partial entry.
+Entries are never removed, clear the directory to free the space. `stats()` reports hits and misses.
+"""
+class DecodedAudioCache:
+    def __init__(self, directory: str, dtype: str = "float32"):
+        if dtype not in AUDIO_CACHE_DTYPES:
+            raise ValueError("Unknown audio cache dtype {0}, expected one of {1}".format(dtype, ", ".join(AUDIO_CACHE_DTYPES)))
+        self.logger = logging.getLogger('DecodedAudioCache')
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, source: str, sample_rate: int) -> str:
+        stat = os.stat(source)
+        description = json.dumps([os.path.abspath(source), stat.st_size, stat.st_mtime_ns, sample_rate, self.dtype.name])
+        return os.path.join(self.directory, "{0}.npy".format(hashlib.blake2b(description.encode(), digest_size=16).hexdigest()))
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    # The memory mapped entry of the source, None if it is not cached.
+    def open(self, source: str, sample_rate: int) -> np.ndarray | None:
+        try:
+            entry = np.load(self._path(source, sample_rate), mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            # ValueError: not a complete .npy file
+            return None
+        return entry
+
+    def _to_float(self, samples: np.ndarray) -> np.ndarray:
+        if self.dtype == np.int16:
+            return samples.astype(np.float32) / INT16_SCALE
+        return np.array(samples, dtype=np.float32)
+
+    def _from_float(self, samples: np.ndarray) -> np.ndarray:
+        if self.dtype == np.int16:
+            return np.clip(np.round(samples * INT16_SCALE), -INT16_SCALE, INT16_SCALE - 1).astype(np.int16)
+        return samples
+
+    """
+    The decoded signal of the source, `length` samples at sample_rate, a block at a time.
+       - decode: decodes the source block by block, called on a miss.
+    A hit reads the blocks from the entry; a miss decodes the source and writes the entry as the blocks are
+    read, and only keeps it if they are all read. `decode` must yield exactly `length` samples (see fit_length).
+    """
+    def blocks(self, source: str, sample_rate: int, length: int, decode: Callable[[], Iterator[np.ndarray]], block_size: int = 1 << 16) -> Iterator[np.ndarray]:
+        entry = self.open(source, sample_rate)
+        if entry is not None and len(entry) == length:
+            self._count(True)
+            for start in range(0, length, block_size):
+                yield self._to_float(entry[start:start + block_size])
+            return
+
+        self._count(False)
+        path = self._path(source, sample_rate)
+        temporary = "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.get_ident())
+        file = None
+        try:
+            file = open(temporary, "wb")
+            np.lib.format.write_array_header_1_0(file, {"descr": np.lib.format.dtype_to_descr(self.dtype), "fortran_order": False, "shape": (length,)})
+        except OSError as e:
+            file = self._abandon(file, source, e)
+
+        written = 0
+        try:
+            for block in decode():
+                if file is not None:
+                    try:
+                        file.write(self._from_float(block[:length - written]).tobytes())
+                    except OSError as e:
+                        file = self._abandon(file, source, e)
+                written += len(block)
+                yield block
+            if file is not None and written == length:
+                file.close()
+                file = None
+                os.replace(temporary, path)
+        finally:
+            if file is not None:
+                file.close()
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    # Failing to write the cache does not fail the read, the recording is decoded without being cached.
+    def _abandon(self, file, source: str, error: OSError) -> None:
+        self.logger.warning("Could not write {0} to the audio cache: {1}".format(source, error))
+        if file is not None:
+            file.close()
+        return None
+
+    # The whole decoded signal of the source, memory mapped on a hit (float32 entries) and written on a miss.
+    def load(self, source: str, sample_rate: int, decode: Callable[[], np.ndarray]) -> np.ndarray:
+        entry = self.open(source, sample_rate)
+        if entry is not None:
+            self._count(True)
+            return entry if self.dtype == np.float32 else self._to_float(entry)
+
+        self._count(False)
+        signal = decode()
+        path = self._path(source, sample_rate)
+        temporary = "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.get_ident())
+        try:
+            with open(temporary, "wb") as file:
+                np.save(file, self._from_float(signal))
+            os.replace(temporary, path)
+        except OSError as e:
+            self.logger.warning("Could not write {0} to the audio cache: {1}".format(source, e))
+            if os.path.exists(temporary):
+                os.remove(temporary)
+        return signal
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "directory": self.directory,
+                "dtype": self.dtype.name,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -1,17 +1,21 @@
 import datetime
 import logging
 import os
-from typing import Tuple
+from typing import Iterator, Tuple
 
 import librosa
 import numpy as np
+import soundfile as sf
 import torch
 from bson.objectid import ObjectId
 from pymongo import MongoClient
 
+from lib.audio_stream import (decode_blocks, decoded_length, fit_length,
+                              read_audio, window_segments)
 from lib.config import Config
 from lib.exceptions import (AudioFileNotFoundError, LoadingAudioBytesError,
                             RecordingNotFoundInDatabaseError)
+from lib.storage.audio_cache import DecodedAudioCache
 from lib.utils import pad_mean
 
 
@@ -19,23 +23,76 @@ from lib.utils import pad_mean
 # This has the following properties:
 # - id: a unique identifier for the audio recording fetched from the database.
 # - path: the path of the audio recording.
-# - bytes: the audio recording in bytes.
+# - bytes: the audio recording in bytes, grouped into overlapping windows.
+# - signal: the whole audio recording the windows were cut from.
 # - datetime_recorded: the date and time the audio recording was recorded.
+# Like a StreamingRecording it gives its windows as segments and its signal as blocks, from memory.
 class AudioRecording:
     bytes: torch.FloatTensor
+    signal: torch.FloatTensor | None
     sample_rate: int
     datetime_recorded: datetime.datetime
     id: ObjectId
     path: str
 
 
-    def __init__(self, id, path, bytes:  torch.FloatTensor, datetime_recorded: datetime.datetime, sample_rate: int = 8000):
+    def __init__(self, id, path, bytes:  torch.FloatTensor, datetime_recorded: datetime.datetime, sample_rate: int = 8000, signal: torch.FloatTensor | None = None):
         self.id = id
         self.path = path
         self.sample_rate = sample_rate
         self.bytes = bytes
+        self.signal = signal
         self.datetime_recorded = datetime_recorded  # type: datetime.datetime
 
+    @property
+    def windows(self) -> int:
+        return self.bytes.shape[0]
+
+    def segments(self, windows_per_segment: int, config: Config = Config.default()) -> Iterator[np.ndarray]:
+        return window_segments(self.blocks(), config.single_batch_length(), config.step_size * config.n_hop, windows_per_segment)
+
+    def blocks(self) -> Iterator[np.ndarray]:
+        yield self.signal.reshape(-1).numpy()
+
+
+# A StreamingRecording is an audio recording that is decoded block by block while it is read, instead of
+# being loaded whole, so the memory it takes does not grow with its length (a 12 hour recording included).
+# It has the same id, path, sample_rate and datetime_recorded as an AudioRecording and:
+# - length: the number of samples at sample_rate, known from the file header.
+# - windows: the number of overlapping windows `fetch` would cut from the recording.
+# - segments(windows_per_segment): the signal of consecutive windows, a segment at a time.
+# - blocks(): the signal, a block at a time.
+# Every call to segments / blocks decodes the file again, or reads it from the audio_cache once it is cached.
+class StreamingRecording:
+    def __init__(self, id, path: str, datetime_recorded: datetime.datetime, config: Config = Config.default(), audio_cache: DecodedAudioCache | None = None):
+        self.id = id
+        self.path = path
+        self.audio_cache = audio_cache
+        self.datetime_recorded = datetime_recorded
+        self.sample_rate = config.sample_rate
+        self.window_length = config.single_batch_length()
+        self.step_length = config.step_size * config.n_hop
+        self.decoded_length = decoded_length(path, self.sample_rate)
+        # Recordings shorter than a window are padded to one, like `fetch` does
+        self.length = max(self.decoded_length, self.window_length)
+        self.windows = (self.length - self.window_length) // self.step_length + 1
+
+    def segments(self, windows_per_segment: int, config: Config = Config.default()) -> Iterator[np.ndarray]:
+        return window_segments(self.blocks(), self.window_length, self.step_length, windows_per_segment)
+
+    def blocks(self) -> Iterator[np.ndarray]:
+        def decode() -> Iterator[np.ndarray]:
+            return fit_length(decode_blocks(self.path, self.sample_rate), self.decoded_length)
+
+        try:
+            blocks = decode() if self.audio_cache is None else self.audio_cache.blocks(self.path, self.sample_rate, self.decoded_length, decode)
+            if self.decoded_length >= self.window_length:
+                yield from blocks
+            else:
+                yield pad_mean(np.concatenate(list(blocks)), self.window_length).astype(np.float32)
+        except Exception as e:
+            raise LoadingAudioBytesError(e)
+
 # An AudioRecordingDatabaseObject is the data that is fetched from the database given the id of an audio recording.
 class AudioRecordingDatabaseObject:
     def __init__(self, id: ObjectId, path: str, datetime_recorded: datetime.datetime):
@@ -68,9 +125,11 @@ class AudioRecordingDatabaseObject:
 class RecordingStorage:
     effects = [["remix", "1"],['gain', '-n'],["highpass", "200"]]
 
-    def __init__(self, database_url: str):
+    # audio_cache: optional disk cache of the decoded recordings, see lib/storage/audio_cache.py.
+    def __init__(self, database_url: str, audio_cache: DecodedAudioCache | None = None):
         self.logger = logging.getLogger('recording_storage')
         self.database = MongoClient(database_url)
+        self.audio_cache = audio_cache
 
     # Fetch an audio recording from the database given the id of the recording.
     #
@@ -83,7 +142,9 @@ class RecordingStorage:
         # Fetch the audio recording from the database.
         database_object: AudioRecordingDatabaseObject = self._fetch_audio_recording_from_database(id)
         self.logger.debug("Database object found {0}".format(database_object))
+        return self._load(database_object, config)
 
+    def _load(self, database_object: AudioRecordingDatabaseObject, config: Config) -> AudioRecording:
         # Use the database object to load the recording.
         self.logger.debug("Loading audio recording from the path provided by the database object ... ")
         audio_bytes, rate = self._load_audio_bytes_for_recording(database_object)
@@ -92,7 +153,24 @@ class RecordingStorage:
 
         batches = self._group_signal_into_batches(audio_bytes, batch_size=config.single_batch_length(), step_size=config.step_size * config.n_hop)
 
-        return AudioRecording(id=database_object.id, path=database_object.path, bytes=batches, datetime_recorded=database_object.datetime_recorded, sample_rate=rate)
+        return AudioRecording(id=database_object.id, path=database_object.path, bytes=batches, datetime_recorded=database_object.datetime_recorded, sample_rate=rate, signal=audio_bytes[0])
+
+    # Same as `fetch`, but the recording is decoded while it is read (see StreamingRecording). Formats soundfile
+    # cannot read (e.g. MP3 with an old libsndfile) are loaded whole by `fetch` instead.
+    #
+    # Throws the same exceptions as `fetch`, LoadingAudioBytesError also while the recording is read.
+    def stream(self, id: str, config: Config = Config.default()) -> "StreamingRecording | AudioRecording":
+        database_object: AudioRecordingDatabaseObject = self._fetch_audio_recording_from_database(id)
+        self.logger.debug("Database object found {0}".format(database_object))
+
+        if not os.path.exists(database_object.path):
+            self.logger.error("Couldn't locate the audio file at the path {0}".format(database_object.path))
+            raise AudioFileNotFoundError()
+        try:
+            return StreamingRecording(id=database_object.id, path=database_object.path, datetime_recorded=database_object.datetime_recorded, config=config, audio_cache=self.audio_cache)
+        except sf.LibsndfileError as e:
+            self.logger.warning("Cannot stream {0}, loading it whole. Reason: {1}".format(database_object.path, e))
+            return self._load(database_object, config)
 
 
     # Queries the database for the audio recording with the given id.
@@ -125,7 +203,9 @@ class RecordingStorage:
         path = audio_recording_database_object.path.replace("data/MozzWear/", "")
         self.logger.debug("Loading audio file with path: {0}".format(path))
         try:
-            signal, sr = librosa.load(audio_recording_database_object.path, sr=8000)
+            if not os.path.exists(audio_recording_database_object.path):
+                raise FileNotFoundError(audio_recording_database_object.path)
+            signal, sr = self._decode(audio_recording_database_object.path, sample_rate=8000), 8000
             print(signal)
 
             return np.array([signal]), sr
@@ -138,6 +218,20 @@ class RecordingStorage:
             self.logger.error("{0}. Reason: {1}".format(type(e),e))
             raise LoadingAudioBytesError(e)
         
+    # Decodes the whole file, from the audio cache when it is cached. soundfile reads it unless it cannot
+    # (e.g. MP3 with an old libsndfile), then librosa does.
+    def _decode(self, path: str, sample_rate: int) -> np.ndarray:
+        def decode() -> np.ndarray:
+            try:
+                return read_audio(path, sample_rate)
+            except sf.LibsndfileError:
+                signal, _ = librosa.load(path, sr=sample_rate)
+                return signal
+
+        if self.audio_cache is None:
+            return decode()
+        return self.audio_cache.load(path, sample_rate, decode)
+
     def _ensure_min_length(self, signal: np.ndarray, min_length: int):
         if(signal.shape[1] < min_length):
             return torch.FloatTensor(np.array(pad_mean(  signal[0], min_length))).unsqueeze(0)
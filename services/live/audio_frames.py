@@ -0,0 +1,229 @@
+import json
+import struct
+import tempfile
+
+import numpy as np
+
+from lib.audio_stream import StreamingResampler, decode_blocks
+from lib.config import Config
+from lib.exceptions import InvalidAudioFrameError
+from lib.inference_executor import InferenceExecutor
+
+# Binary audio frames sent by live clients over the /med and /msc websockets.
+# A frame is a 12 byte little-endian header followed by its payload:
+#   magic        4 bytes   b"HBAF"
+#   encoding     uint8     ENCODING_FLOAT32, ENCODING_INT16 or ENCODING_CONTAINER
+#   channels     uint8     number of interleaved channels, mixed down to mono (ignored for containers)
+#   flags        uint16    FLAG_MORE when more frames of the same clip follow
+#   sample_rate  uint32    sample rate of the samples in Hz (ignored for containers)
+# PCM payloads are raw little-endian samples, interleaved when there is more than one channel.
+# Container payloads are (a piece of) an encoded file soundfile can read, e.g. FLAC, OGG or WAV.
+# Audio at other sample rates is resampled to Config.sample_rate.
+# Text frames holding a JSON array of floats are still accepted for older clients.
+FRAME_HEADER = struct.Struct("<4sBBHI")
+FRAME_MAGIC = b"HBAF"
+
+ENCODING_FLOAT32 = 1
+ENCODING_INT16 = 2
+ENCODING_CONTAINER = 3
+
+FLAG_MORE = 1
+
+SAMPLE_TYPES = {
+    ENCODING_FLOAT32: np.dtype("<f4"),
+    ENCODING_INT16: np.dtype("<i2"),
+}
+
+# Encoded uploads are kept in memory up to this size, then spooled to a temporary file.
+CONTAINER_SPOOL_SIZE = 8 * 1024 * 1024
+
+# Payload bytes the binary frames of one clip may add up to, encoded or PCM, before the clip is rejected.
+MAX_CLIP_BYTES = 256 * 1024 * 1024
+
+
+def encode_frame(samples: np.ndarray, sample_rate: int, encoding: int = ENCODING_FLOAT32, channels: int = 1, more: bool = False) -> bytes:
+    header = FRAME_HEADER.pack(FRAME_MAGIC, encoding, channels, FLAG_MORE if more else 0, sample_rate)
+    return header + np.ascontiguousarray(samples, dtype=SAMPLE_TYPES[encoding]).tobytes()
+
+
+def encode_container_frames(data: bytes, frame_size: int = 1024 * 1024) -> list[bytes]:
+    chunks = [data[start:start + frame_size] for start in range(0, len(data), frame_size)] or [b""]
+    return [
+        FRAME_HEADER.pack(FRAME_MAGIC, ENCODING_CONTAINER, 0, FLAG_MORE if index < len(chunks) - 1 else 0, 0) + chunk
+        for index, chunk in enumerate(chunks)
+    ]
+
+
+def _parse_header(message: bytes) -> tuple[int, int, int, int]:
+    if len(message) < FRAME_HEADER.size:
+        raise InvalidAudioFrameError("Audio frame is shorter than its {0} byte header.".format(FRAME_HEADER.size))
+
+    magic, encoding, channels, flags, sample_rate = FRAME_HEADER.unpack_from(message)
+    if magic != FRAME_MAGIC:
+        raise InvalidAudioFrameError("Audio frame does not start with {0}.".format(FRAME_MAGIC))
+    if encoding not in SAMPLE_TYPES and encoding != ENCODING_CONTAINER:
+        raise InvalidAudioFrameError("Unsupported sample encoding {0}.".format(encoding))
+    if encoding != ENCODING_CONTAINER and (channels < 1 or sample_rate < 1):
+        raise InvalidAudioFrameError("PCM audio frames need at least one channel and a sample rate.")
+    return encoding, channels, flags, sample_rate
+
+
+# Decodes the PCM payload of a binary frame into mono float32 samples at the frame's own sample rate.
+# Mono float32 payloads are returned as a read-only view of the message, without copying.
+def _decode_pcm(message: bytes, encoding: int, channels: int) -> np.ndarray:
+    sample_type = SAMPLE_TYPES[encoding]
+    payload_size = len(message) - FRAME_HEADER.size
+    if payload_size % (sample_type.itemsize * channels) != 0:
+        raise InvalidAudioFrameError("Audio payload of {0} bytes is not a whole number of {1} channel samples.".format(payload_size, channels))
+
+    samples = np.frombuffer(message, dtype=sample_type, offset=FRAME_HEADER.size)
+    if encoding == ENCODING_INT16:
+        samples = samples.astype(np.float32) / 32768.0
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1, dtype=np.float32)
+    return samples
+
+
+def decode_binary_frame(message: bytes, config: Config = Config.default()) -> np.ndarray:
+    encoding, channels, _, sample_rate = _parse_header(message)
+    if encoding == ENCODING_CONTAINER:
+        raise InvalidAudioFrameError("Encoded audio has to go through an AudioReceiver.")
+    return StreamingResampler(sample_rate, config.sample_rate).process(_decode_pcm(message, encoding, channels), last=True)
+
+
+def decode_text_frame(message: str) -> np.ndarray:
+    try:
+        return np.array(json.loads(message), dtype=np.float32)
+    except (ValueError, TypeError) as e:
+        raise InvalidAudioFrameError("Text frames must hold a JSON array of samples. {0}".format(e))
+
+
+# Collects the frames of one clip sent over a websocket. Frames are only checked and kept as they arrive, the
+# event loop receives them; PCM and JSON frames are decoded and resampled, and encoded container bytes spooled
+# until the last frame are decoded block by block, in `take_clip`.
+# A clip whose frames carry more than `max_clip_bytes` of payload is dropped and rejected.
+class AudioReceiver:
+    def __init__(self, config: Config = Config.default(), max_clip_bytes: int = MAX_CLIP_BYTES):
+        self.config = config
+        self.max_clip_bytes = max_clip_bytes
+        self._reset()
+
+    def _reset(self):
+        self.frames: list[bytes] = []
+        self.text: str | None = None
+        self.pcm_format: tuple[int, int, int] | None = None
+        self.container = None
+        self.clip_bytes = 0
+
+    # Adds a frame, returns True once the frame completed a clip.
+    def add_binary(self, message: bytes) -> bool:
+        encoding, channels, flags, sample_rate = _parse_header(message)
+        more = bool(flags & FLAG_MORE)
+
+        self.clip_bytes += len(message) - FRAME_HEADER.size
+        if self.clip_bytes > self.max_clip_bytes:
+            self.close()
+            raise InvalidAudioFrameError("The audio of a clip may not exceed {0} bytes.".format(self.max_clip_bytes))
+
+        if encoding == ENCODING_CONTAINER:
+            if self.pcm_format is not None:
+                raise InvalidAudioFrameError("Cannot mix encoded and PCM frames in one clip.")
+            if self.container is None:
+                self.container = tempfile.SpooledTemporaryFile(max_size=CONTAINER_SPOOL_SIZE)
+            self.container.write(memoryview(message)[FRAME_HEADER.size:])
+            return not more
+
+        if self.container is not None:
+            raise InvalidAudioFrameError("Cannot mix encoded and PCM frames in one clip.")
+        if self.pcm_format is None:
+            self.pcm_format = (encoding, channels, sample_rate)
+        elif self.pcm_format != (encoding, channels, sample_rate):
+            raise InvalidAudioFrameError("All frames of a clip must share encoding, channels and sample rate.")
+        self.frames.append(message)
+        return not more
+
+    def add_text(self, message: str) -> bool:
+        if self.pcm_format is not None or self.container is not None:
+            raise InvalidAudioFrameError("Cannot mix JSON and binary frames in one clip.")
+        self.text = message
+        return True
+
+    # Returns the complete clip as mono float32 at Config.sample_rate and gets ready for the next one.
+    # Decoding and resampling are CPU bound, call this off the event loop.
+    def take_clip(self) -> np.ndarray:
+        try:
+            if self.container is not None:
+                self.container.seek(0)
+                try:
+                    blocks = list(decode_blocks(self.container, self.config.sample_rate))
+                except RuntimeError as e:
+                    raise InvalidAudioFrameError("Could not decode the uploaded audio. {0}".format(e))
+            elif self.pcm_format is not None:
+                encoding, channels, sample_rate = self.pcm_format
+                resampler = StreamingResampler(sample_rate, self.config.sample_rate)
+                blocks = [
+                    resampler.process(_decode_pcm(message, encoding, channels), last=index == len(self.frames) - 1)
+                    for index, message in enumerate(self.frames)
+                ]
+            else:
+                blocks = [decode_text_frame(self.text)]
+            # A single block is returned as is, which keeps mono float32 frames at the right rate zero-copy
+            return blocks[0] if len(blocks) == 1 else np.concatenate(blocks)
+        finally:
+            self.close()
+
+    # Drops the frames of an unfinished clip, e.g. when the connection ends in the middle of it.
+    def close(self):
+        if self.container is not None:
+            self.container.close()
+        self._reset()
+
+
+# Decodes the PCM frames of an open ended stream, e.g. /med/stream, into mono float32 at Config.sample_rate.
+# Every frame keeps the encoding, channels and sample rate of the first one so the resampler runs continuously
+# across frames. A frame without FLAG_MORE ends the stream. JSON text frames are decoded as they come.
+class AudioStreamDecoder:
+    def __init__(self, config: Config = Config.default()):
+        self.config = config
+        self.resampler: StreamingResampler | None = None
+        self.pcm_format: tuple[int, int, int] | None = None
+        self.ended = False
+
+    def add_binary(self, message: bytes) -> np.ndarray:
+        encoding, channels, flags, sample_rate = _parse_header(message)
+        if encoding == ENCODING_CONTAINER:
+            raise InvalidAudioFrameError("Streams only accept PCM frames.")
+        if self.pcm_format is None:
+            self.pcm_format = (encoding, channels, sample_rate)
+            self.resampler = StreamingResampler(sample_rate, self.config.sample_rate)
+        elif self.pcm_format != (encoding, channels, sample_rate):
+            raise InvalidAudioFrameError("All frames of a stream must share encoding, channels and sample rate.")
+        self.ended = not flags & FLAG_MORE
+        return self.resampler.process(_decode_pcm(message, encoding, channels), last=self.ended)
+
+    def add_text(self, message: str) -> np.ndarray:
+        if self.pcm_format is not None:
+            raise InvalidAudioFrameError("Cannot mix JSON and binary frames in one stream.")
+        return decode_text_frame(message)
+
+    # Flushes the samples the resampler still holds when the client disconnects without a final frame.
+    def flush(self) -> np.ndarray:
+        if self.resampler is None or self.ended:
+            return np.zeros(0, dtype=np.float32)
+        self.ended = True
+        return self.resampler.process(np.zeros(0, dtype=np.float32), last=True)
+
+
+# Receives the next complete clip from the websocket, from one or more binary frames or a JSON text frame.
+# The clip is assembled on `executor`. Returns None once the client has disconnected.
+async def receive_audio(websocket, receiver: AudioReceiver, executor: InferenceExecutor) -> np.ndarray | None:
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return None
+        if message.get("bytes") is not None:
+            complete = receiver.add_binary(message["bytes"])
+        else:
+            complete = receiver.add_text(message["text"])
+        if complete:
+            return await executor.run(receiver.take_clip)
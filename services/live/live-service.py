@@ -5,15 +5,19 @@ import os
 import sys
 import threading
 
-import numpy as np
 import pandas as pd
 from fastapi import FastAPI, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from fastapi.websockets import WebSocketDisconnect, WebSocketState
 
 from lib.classifier import Classifier
 from lib.custom_types import Environment
 from lib.exceptions import DescriptiveError
+from lib.inference_executor import InferenceExecutor
+from lib.runtime import ThreadTopology
+from services.live.audio_frames import (AudioReceiver, AudioStreamDecoder,
+                                        receive_audio)
 
 app = FastAPI()
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
@@ -27,49 +31,62 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-classifier = Classifier(Environment(dict(os.environ)))
+environment = Environment(dict(os.environ))
+# Splits the cores between the inference workers, applied by the classifier before it loads the models
+runtime = ThreadTopology.from_environment(environment, workers=environment.inference_workers)
+# Loads the PRELOAD_MODELS in the background, /health answers right away and /ready once they are warmed up;
+# the other models are loaded on first use
+classifier = Classifier(environment, runtime, background=True)
+# Every model call and decode runs here, never on the event loop
+inference = InferenceExecutor(environment.inference_workers, initializer=runtime.initialize_worker)
 # Set Pandas options to display full DataFrame in logs
 pd.set_option('display.max_rows', None)
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', None)
 pd.set_option('display.max_colwidth', None)
 
-def _start_async():
-    loop = asyncio.new_event_loop()
-    threading.Thread(target=loop.run_forever).start()
-    return loop
-
-_loop = _start_async()
+# Returns a progress callback for the inference threads that sends its updates on the handler's event loop.
+def progress_sender(websocket: WebSocket):
+    loop = asyncio.get_running_loop()
+    def on_progress(progress: float, status: str):
+        if (websocket.client_state == WebSocketState.CONNECTED):
+            asyncio.run_coroutine_threadsafe(websocket.send_text(json.dumps({"type": "progress", "data": {"progress": progress, "message": status}})), loop)
+    return on_progress
 
-# Submits awaitable to the event loop, but *doesn't* wait for it to
-# complete. Returns a concurrent.futures.Future which *may* be used to
-# wait for and retrieve the result (or exception, if one was raised)
-def submit_async(awaitable):
-    return asyncio.run_coroutine_threadsafe(awaitable, _loop)
+@app.on_event("shutdown")
+def shutdown():
+    inference.shutdown()
+    classifier.shutdown()
 
 @app.get("/health")
 async def health():
-    return {"status": "ok"}
+    return {"status": "ok", "inference": inference.status(), "models": classifier.load_status()}
+
+@app.get("/ready")
+async def ready():
+    status = classifier.load_status()
+    if not status["ready"]:
+        return JSONResponse(status_code=503, content={"status": "error" if status["error"] else "loading", "models": status})
+    return {"status": "ready", "models": status}
+
+@app.get("/metrics")
+async def metrics():
+    return {"inference": inference.status(), "threads": runtime.layout(), "batching": classifier.batching_metrics(), "models": classifier.model_stats(), "result_cache": classifier.result_cache_stats()}
 
 @app.websocket("/med")
 async def event_detection(websocket: WebSocket):
     await websocket.accept()
 
     abort_signal = threading.Event()
-    
-    def on_progress(progress: float, status: str):
-        if (websocket.client_state == WebSocketState.CONNECTED):
-            submit_async(websocket.send_text(json.dumps({"type": "progress", "data": {"progress": progress, "message": status}})))
+    receiver = AudioReceiver()
+    on_progress = progress_sender(websocket)
 
     try:
         while websocket.client_state == WebSocketState.CONNECTED:
-            message = await websocket.receive_text()
-            if (message is None): break
-
-            bytes = json.loads(message)
-            np_bytes = np.array(bytes, dtype=np.float32)
+            np_bytes = await receive_audio(websocket, receiver, inference)
+            if (np_bytes is None): break
 
-            events = classifier.med(np_bytes, send_update_to_client=on_progress, abort_signal=abort_signal)
+            events = await inference.run(classifier.med, np_bytes, send_update_to_client=on_progress, abort_signal=abort_signal)
             completed_message = {"type": "complete", "data": events.__dict__()}
             await websocket.send_json(completed_message)
 
@@ -91,6 +108,65 @@ async def event_detection(websocket: WebSocket):
     finally:
         if not abort_signal.is_set():
             abort_signal.set()
+        receiver.close()
+        print("Connection closed")
+        if websocket.client_state == WebSocketState.CONNECTED:
+            await websocket.close()
+
+# Streaming MED: the client keeps sending PCM frames, every complete window is classified as soon as it arrives
+# and its probabilities and any event boundaries are pushed back. The stream ends with a frame without FLAG_MORE
+# (or a disconnect), then the last partial window is classified and a "complete" message is sent.
+@app.websocket("/med/stream")
+async def streaming_event_detection(websocket: WebSocket):
+    await websocket.accept()
+
+    decoder = AudioStreamDecoder()
+    # Waits on an inference thread while the MED model is loading
+    detector = await inference.run(classifier.med_stream)
+
+    # Decodes a frame and classifies the windows it completes, on an inference thread
+    def consume(message: dict) -> list[dict]:
+        if message.get("bytes") is not None:
+            return detector.push(decoder.add_binary(message["bytes"]))
+        return detector.push(decoder.add_text(message["text"]))
+
+    def finish() -> list[dict]:
+        return detector.push(decoder.flush()) + detector.finish()
+
+    async def send_messages(messages: list[dict]):
+        for message in messages:
+            await websocket.send_json(message)
+
+    try:
+        while not decoder.ended:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            await send_messages(await inference.run(consume, message))
+
+        if websocket.client_state == WebSocketState.CONNECTED:
+            await send_messages(await inference.run(finish))
+            await websocket.send_json({"type": "complete", "data": {"windows": detector.windows_classified}})
+
+    except DescriptiveError as e:
+        print(f"Descriptive error: {e.description}")
+        if websocket.client_state == WebSocketState.CONNECTED:
+            await websocket.send_text(json.dumps({"type": "error", "data": e.__dict__()}))
+    except WebSocketDisconnect:
+        print("Client disconnected")
+    except Exception as e:
+        print("Error raised: ", e)
+        if websocket.client_state == WebSocketState.CONNECTED:
+            await websocket.send_text(json.dumps({"type": "error", "data": {
+                "id": "server_error",
+                "error": "Internal server error",
+                "message": str(e),
+                "status_code": 500
+            }}))
+
+    finally:
+        # Returns the stream's lease on the MED model
+        detector.close()
         print("Connection closed")
         if websocket.client_state == WebSocketState.CONNECTED:
             await websocket.close()
@@ -100,17 +176,15 @@ async def species_classification(websocket: WebSocket):
     await websocket.accept()
     
     abort_signal = threading.Event()
-    def on_progress(progress: float, status: str):
-        if (websocket.client_state == WebSocketState.CONNECTED):
-            submit_async(websocket.send_text(json.dumps({"type": "progress", "data": {"progress": progress, "message": status}})))
-            
+    receiver = AudioReceiver()
+    on_progress = progress_sender(websocket)
+
     try:
         while websocket.client_state == WebSocketState.CONNECTED:
-            message = await websocket.receive_text()
-            if (message is None): break
-            np_bytes = np.array(bytes, dtype=np.float32)
+            np_bytes = await receive_audio(websocket, receiver, inference)
+            if (np_bytes is None): break
 
-            results = await asyncio.get_running_loop().run_in_executor(None, classifier.msc, np_bytes, on_progress, abort_signal)
+            results = await inference.run(classifier.msc, np_bytes, on_progress, abort_signal)
             completed_message = {"type": "complete", "data": results.__dict__()}
             await websocket.send_json(completed_message)
 
@@ -136,6 +210,7 @@ async def species_classification(websocket: WebSocket):
         # Cancel the progress processing task
         if not abort_signal.is_set():
             abort_signal.set()
+        receiver.close()
         print("Connection closed")
         if websocket.client_state == WebSocketState.CONNECTED:
             await websocket.close()
\ No newline at end of file
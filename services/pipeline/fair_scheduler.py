@@ -0,0 +1,231 @@
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from logging import getLogger
+from typing import Callable
+
+from lib.exceptions import UserCancelledError
+
+
+"""
+A job the FairScheduler runs in pieces:
+   - start(): runs once, e.g. fetches the recording, and returns the number of chunks.
+   - run_chunk(index): runs one chunk. Chunks of a job can run at the same time on different workers.
+   - cost(index): the share of the worker the chunk uses, e.g. its number of windows.
+   - finish(): runs once after the last chunk.
+   - fail(error): runs instead of the remaining steps when a step raised or the job was cancelled, once the
+     steps still running are over.
+The weight is the share of the workers the job's submitter gets relative to other submitters.
+"""
+class ScheduledJob(ABC):
+    def __init__(self, job_id: str, submitter: str, weight: float = 1.0):
+        self.job_id = job_id
+        self.submitter = submitter
+        self.weight = weight
+        self.abort_signal = threading.Event()
+
+    @abstractmethod
+    def start(self) -> int:
+        ...
+
+    def cost(self, index: int) -> float:
+        return 1.0
+
+    @abstractmethod
+    def run_chunk(self, index: int):
+        ...
+
+    @abstractmethod
+    def finish(self):
+        ...
+
+    @abstractmethod
+    def fail(self, error: Exception):
+        ...
+
+
+class _JobState:
+    def __init__(self, job: ScheduledJob):
+        self.job = job
+        self.started = False
+        self.starting = False
+        self.total: int | None = None
+        self.next_chunk = 0
+        self.chunks_done = 0
+        # Steps picked and not over yet
+        self.running = 0
+        # Why the job stops, it fails once `running` drops to 0
+        self.error: Exception | None = None
+        self.finished = False
+
+
+"""
+Weighted fair queuing of job chunks between submitters (start-time fair queuing).
+The next chunk comes from the submitter with the smallest start tag max(virtual time, its last finish tag),
+which then advances by cost / weight of the job the chunk belongs to; the jobs of one submitter take turns
+chunk by chunk. A short job submitted while a long one runs is interleaved with it right away instead of
+waiting for it to finish. At most `max_active_jobs` jobs are started at once, so only their audio is held
+in memory; the others wait until one of them is done.
+"""
+class FairScheduler:
+    def __init__(self, max_active_jobs: int = 4):
+        self.logger = getLogger(__name__)
+        self.max_active_jobs = max(1, max_active_jobs)
+        self.condition = threading.Condition()
+        self.jobs: dict[str, _JobState] = {}
+        self.submitter_jobs: dict[str, deque[_JobState]] = {}
+        self.finish_tags: dict[str, float] = {}
+        self.virtual_time = 0.0
+
+    # Returns the job that will run: `job`, or the waiting or running job that already has its id.
+    def submit(self, job: ScheduledJob) -> ScheduledJob:
+        with self.condition:
+            existing = self.jobs.get(job.job_id)
+            if existing is not None and not existing.finished and existing.error is None:
+                existing.job.weight = max(existing.job.weight, job.weight)
+                return existing.job
+            state = _JobState(job)
+            self.jobs[job.job_id] = state
+            self.submitter_jobs.setdefault(job.submitter, deque()).append(state)
+            self.condition.notify_all()
+            return job
+
+    def cancel(self, job_id: str) -> bool:
+        with self.condition:
+            state = self.jobs.get(job_id)
+            if state is None or state.finished or state.error is not None:
+                return False
+            state.job.abort_signal.set()
+            state.error = UserCancelledError()
+            if state.running > 0:
+                # The steps running see the abort signal, the last one to end fails the job
+                return True
+            self._remove(state)
+        state.job.fail(state.error)
+        return True
+
+    def active_jobs(self) -> list[ScheduledJob]:
+        with self.condition:
+            return [state.job for state in self.jobs.values() if state.started or state.starting]
+
+    def waiting_jobs(self) -> list[ScheduledJob]:
+        with self.condition:
+            return [state.job for state in self.jobs.values() if not (state.started or state.starting)]
+
+    # Runs chunks forever, call from every worker thread.
+    def work(self):
+        while True:
+            self.next()()
+
+    # Blocks until a step can run and returns it.
+    def next(self) -> Callable[[], None]:
+        with self.condition:
+            while True:
+                step = self._pick()
+                if step is not None:
+                    return step
+                self.condition.wait()
+
+    def _runnable(self, state: _JobState, active: int) -> bool:
+        if state.finished or state.starting or state.error is not None:
+            return False
+        if not state.started:
+            return active < self.max_active_jobs
+        return state.next_chunk < state.total
+
+    def _pick(self) -> Callable[[], None] | None:
+        active = sum(1 for state in self.jobs.values() if state.started or state.starting)
+        best = None
+        for submitter, states in self.submitter_jobs.items():
+            if not any(self._runnable(state, active) for state in states):
+                continue
+            start_tag = max(self.virtual_time, self.finish_tags.get(submitter, 0.0))
+            if best is None or start_tag < best[0]:
+                best = (start_tag, submitter)
+        if best is None:
+            return None
+
+        start_tag, submitter = best
+        states = self.submitter_jobs[submitter]
+        # Round robin between the jobs of the submitter
+        while not self._runnable(states[0], active):
+            states.rotate(-1)
+        state = states[0]
+        states.rotate(-1)
+
+        state.running += 1
+        if not state.started:
+            state.starting = True
+            cost = 1.0
+            step = lambda: self._start(state)
+        else:
+            index = state.next_chunk
+            state.next_chunk += 1
+            cost = state.job.cost(index)
+            step = lambda: self._run_chunk(state, index)
+
+        self.virtual_time = start_tag
+        self.finish_tags[submitter] = start_tag + cost / state.job.weight
+        return step
+
+    def _start(self, state: _JobState):
+        finished = False
+        try:
+            total = state.job.start()
+            with self.condition:
+                state.starting = False
+                state.started = True
+                state.total = total
+                finished = total == 0 and state.error is None
+                self.condition.notify_all()
+            if finished:
+                state.job.finish()
+        except Exception as e:
+            self._end_step(state, e)
+            return
+        self._end_step(state, finished=finished)
+
+    def _run_chunk(self, state: _JobState, index: int):
+        if state.error is not None:
+            self._end_step(state)
+            return
+        finished = False
+        try:
+            state.job.run_chunk(index)
+            with self.condition:
+                state.chunks_done += 1
+                finished = state.chunks_done == state.total and state.error is None
+            if finished:
+                state.job.finish()
+        except Exception as e:
+            self._end_step(state, e)
+            return
+        self._end_step(state, finished=finished)
+
+    # A step raising or a cancel stops the job from taking chunks, and the last step to end fails it, so no step
+    # still running sees the job release what it holds.
+    def _end_step(self, state: _JobState, error: Exception | None = None, finished: bool = False):
+        with self.condition:
+            state.running -= 1
+            if finished:
+                self._remove(state)
+                return
+            if error is not None and state.error is None:
+                state.error = error
+            if state.error is None or state.running > 0 or state.finished:
+                return
+            self._remove(state)
+        self.logger.info(f"Job {state.job.job_id} stopped: {type(state.error).__name__} {state.error}")
+        state.job.fail(state.error)
+
+    def _remove(self, state: _JobState):
+        state.finished = True
+        if self.jobs.get(state.job.job_id) is state:
+            del self.jobs[state.job.job_id]
+        states = self.submitter_jobs.get(state.job.submitter)
+        if states is not None:
+            states.remove(state)
+            if not states:
+                del self.submitter_jobs[state.job.submitter]
+                self.finish_tags.pop(state.job.submitter, None)
+        self.condition.notify_all()
@@ -2,13 +2,16 @@ import os
 
 from fastapi import FastAPI, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from fastapi.websockets import WebSocketState
 
 from lib.classifier import Classifier
 from lib.exceptions import DescriptiveError
 from lib.custom_types import Environment
+from lib.runtime import ThreadTopology
 from services.pipeline.processing_queue import ProcessingQueue
-from services.pipeline.processing_recordings import PendingRecording
+from services.pipeline.processing_recordings import (PRIORITY_BULK,
+                                                      PendingRecording)
 
 app = FastAPI()
 
@@ -21,9 +24,35 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-classifier = Classifier(Environment(os.environ))
+environment = Environment(os.environ)
+# Splits the cores between the pipeline workers, applied by the classifier before it loads the models
+runtime = ThreadTopology.from_environment(environment, workers=environment.pipeline_workers)
+# Loads the PRELOAD_MODELS in the background, recordings queued meanwhile wait for the MED model
+classifier = Classifier(environment, runtime, background=True)
 
-processing_queue = ProcessingQueue(classifier)
+processing_queue = ProcessingQueue(classifier, max_workers=environment.pipeline_workers, chunk_windows=environment.pipeline_chunk_windows, thread_initializer=runtime.initialize_worker)
+
+@app.on_event("shutdown")
+def shutdown():
+    classifier.shutdown()
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "models": classifier.load_status(), "audio_cache": classifier.audio_cache_stats(), "progress": processing_queue.bus.stats()}
+
+@app.get("/ready")
+async def ready():
+    status = classifier.load_status()
+    if not status["ready"]:
+        return JSONResponse(status_code=503, content={"status": "error" if status["error"] else "loading", "models": status})
+    return {"status": "ready", "models": status}
+
+# Queues recordings for event detection behind every interactive /med/{recording_id} request.
+@app.post("/backfill")
+async def backfill(recording_ids: list[str]):
+    for recording_id in recording_ids:
+        processing_queue.add(PendingRecording.med(recording_id, priority=PRIORITY_BULK, submitter="backfill"))
+    return {"queued": len(recording_ids)}
 
 @app.websocket("/updates")
 async def handle_new_client(websocket: WebSocket):
@@ -49,7 +78,8 @@ async def handle_recording_client(websocket: WebSocket, recording_id: str):
     await websocket.accept()
 
     processing_queue.watch_recording(recording_id, websocket)
-    processing_queue.add(PendingRecording.med(recording_id))
+    submitter = websocket.client.host if websocket.client is not None else "default"
+    processing_queue.add(PendingRecording.med(recording_id, submitter=submitter))
 
     try:
         while not websocket.client_state== WebSocketState.DISCONNECTED:
@@ -60,4 +90,4 @@ async def handle_recording_client(websocket: WebSocket, recording_id: str):
         print(f"Connection error: {e}")
     finally:
         print("Removing client")
-        processing_queue.remove_recording_observer(recording_id)
+        processing_queue.remove_recording_observer(recording_id, websocket)
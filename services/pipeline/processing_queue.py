@@ -1,132 +1,200 @@
 import asyncio
 import threading
-from collections import deque
-from concurrent.futures import ThreadPoolExecutor
 from logging import Logger, getLogger
+from typing import Callable
 
+import numpy as np
 from fastapi import WebSocket
 
 from lib.classifier import Classifier
+from lib.custom_types import DetectedEvents
 from lib.exceptions import UserCancelledError
-from services.pipeline.processing_recordings import (PendingRecording,
+from services.pipeline.fair_scheduler import FairScheduler, ScheduledJob
+from services.pipeline.processing_recordings import (PRIORITY_WEIGHTS,
+                                                      PendingRecording,
                                                       ProcessingRecording)
-
-queue_thread = ThreadPoolExecutor()
-
+from services.pipeline.progress_bus import ProgressBus
+
+# Progress bus topics, all queue changes and the progress of a single recording.
+GENERAL_TOPIC = "general"
+
+
+def recording_topic(recording_id: str) -> str:
+    return f"recording/{recording_id}"
+
+
+"""
+A recording processed by the FairScheduler in three steps:
+   - start: opens the recording and splits its windows into chunks of `chunk_windows`.
+   - run_chunk: decodes the audio of the next chunk and classifies its windows, `batch_size` at a time.
+   - finish: builds the events from the predictions of all chunks and writes the outputs.
+The recording is decoded a chunk at a time, in order, so memory does not grow with its length; chunks running
+on several workers at once take the next undecoded chunk, whatever index they were scheduled as.
+The job holds a lease on the MED model from start until it finishes or fails, so it is not evicted in between.
+"""
+class RecordingJob(ScheduledJob):
+    def __init__(self, processing_queue: "ProcessingQueue", recording: PendingRecording, chunk_windows: int):
+        super().__init__(f"{recording.type}/{recording.recording_id}", recording.submitter, PRIORITY_WEIGHTS.get(recording.priority, 1.0))
+        self.processing_queue = processing_queue
+        self.classifier = processing_queue.classifier
+        self.pending = recording
+        self.chunk_windows = max(1, chunk_windows)
+        self.processing = ProcessingRecording(recording_id=recording.recording_id, type=recording.type, task=None, abort_signal=self.abort_signal, priority=recording.priority)
+        self.lock = threading.Lock()
+        self.decode_lock = threading.Lock()
+        self.windows_done = 0
+        self.event_detector = None
+        self.segments = None
+
+    def start(self) -> int:
+        print(f"Processing recording {self.pending.recording_id}")
+        match self.pending.type:
+            case "med":
+                self.recording = self.classifier.fetch_recording(self.pending.recording_id)
+                self.event_detector = self.classifier.models.acquire("med")
+                try:
+                    self.total, self.segments = self.classifier.med_segments(self.event_detector, self.recording, self.chunk_windows)
+                except Exception:
+                    self.release_model()
+                    raise
+                chunks = -(-self.total // self.chunk_windows)
+                self.predictions: list[np.ndarray | None] = [None] * chunks
+                self.update(0, f"Recording opened, {self.total} windows to classify.")
+                return chunks
+            case "msc":
+                print("Not implemented yet")
+        return 0
+
+    def cost(self, index: int) -> float:
+        return min(self.chunk_windows, self.total - index * self.chunk_windows)
+
+    def run_chunk(self, index: int):
+        with self.decode_lock:
+            first, count, predict_windows = next(self.segments)
+        batch_size = self.event_detector.batch_size
+        probabilities = []
+        for batch_start in range(0, count, batch_size):
+            if self.abort_signal.is_set():
+                raise UserCancelledError()
+            probabilities.append(predict_windows(batch_start, min(batch_start + batch_size, count)).cpu().numpy().astype(np.float64))
+        self.predictions[first // self.chunk_windows] = np.concatenate(probabilities)
+
+        with self.lock:
+            self.windows_done += count
+            done = self.windows_done
+        self.update((done - 1) / self.total * 100, f"Window {done} of {self.total} has been classified.")
+
+    def finish(self):
+        if self.pending.type == "med":
+            events = DetectedEvents(np.concatenate(self.predictions) if self.predictions else np.empty((0, 2)), self.event_detector.model_checkpoint)
+            self.release_model()
+            _, path = self.classifier.finalize_med_recording(self.recording, events)
+            self.update(100, "completed, path: " + str(path))
+        print("task completed")
+        self.processing_queue.job_done(self)
+
+    def fail(self, error: Exception):
+        self.release_model()
+        if isinstance(error, UserCancelledError):
+            print("cancelled")
+            self.update(100, "cancelled")
+        else:
+            print(f"Error processing recording: {str(error)}")
+            self.update(100, f"error: {str(error)}")
+        self.processing_queue.job_done(self)
+
+    def release_model(self):
+        with self.lock:
+            event_detector, self.event_detector = self.event_detector, None
+        if event_detector is not None:
+            # Closes the recording's file, a chunk still decoding finishes first
+            with self.decode_lock:
+                if self.segments is not None:
+                    self.segments.close()
+            self.classifier.models.release("med")
+
+    def update(self, progress: float, status: str):
+        self.processing.update(progress, status)
+        self.processing_queue.publish_progress(self, final=progress >= 100)
+
+
+"""
+Processes recordings on `max_workers` threads (PIPELINE_WORKERS) with a FairScheduler.
+Recordings are split into chunks of `chunk_windows` windows (PIPELINE_CHUNK_WINDOWS) and chunks of different
+recordings and submitters are interleaved, so a short recording finishes quickly while a long one is running.
+Every worker thread runs `thread_initializer` first, e.g. to take its share of the cores.
+Interactive requests (PRIORITY_INTERACTIVE) get a larger share of the workers than backfills (PRIORITY_BULK).
+Observers are updated through a ProgressBus: general observers get a "snapshot" of the started ("processing")
+and waiting ("queue") jobs when they connect, then one "queued", "progress" or "removed" message per job change.
+"""
 class ProcessingQueue:
     logger: Logger
-    general_observers: list[WebSocket] = []
-    recording_observers: dict[str, WebSocket] = {}
     classifier: Classifier
+    scheduler: FairScheduler
+    bus: ProgressBus
 
-    current_processing: ProcessingRecording | None = None
-    queue = deque[PendingRecording]()
-
-    def __init__(self, classifier: Classifier):
+    def __init__(self, classifier: Classifier, max_workers: int = 1, chunk_windows: int = 32, thread_initializer: Callable[[], None] | None = None):
         self.classifier = classifier
-        self.general_observers = []
-        self.recording_observers = {}
+        self.max_workers = max(1, max_workers)
+        self.chunk_windows = chunk_windows
+        self.thread_initializer = thread_initializer
+        # Only a few recordings are held in memory at once, the others wait until one is done
+        self.scheduler = FairScheduler(max_active_jobs=self.max_workers * 2)
         self.logger = getLogger(__name__)
         self.loop = asyncio.get_event_loop()
+        self.bus = ProgressBus(self.loop)
+        for index in range(self.max_workers):
+            threading.Thread(target=self._work, name=f"pipeline-{index}", daemon=True).start()
+
+    def _work(self):
+        if self.thread_initializer is not None:
+            self.thread_initializer()
+        self.scheduler.work()
 
+    # A recording that is already waiting or running is not queued again, its watchers share the running job.
     def add(self, pending_recording: PendingRecording):
-        self.queue.append(pending_recording)
-        self.logger.info(f"Added recording {pending_recording.recording_id}. Queue size: {len(self.queue)}")
-        self.update_general_observers()
-        self.process()
-
-    def process(self):
-        if self.current_processing is not None or len(self.queue) == 0:
-            self.logger.info(f"No recordings to process. Current processing: {self.current_processing}, queue size: {len(self.queue)}")
+        job = self.scheduler.submit(RecordingJob(self, pending_recording, self.chunk_windows))
+        if job.pending is not pending_recording:
+            self.logger.info(f"Recording {pending_recording.recording_id} is already being processed, {pending_recording.submitter} joins it.")
+            # The scheduler gave the job the larger weight, its observers see the priority that goes with it
+            if PRIORITY_WEIGHTS.get(pending_recording.priority, 1.0) > PRIORITY_WEIGHTS.get(job.pending.priority, 1.0):
+                job.pending.priority = job.processing.priority = pending_recording.priority
+                if job in self.scheduler.active_jobs():
+                    self.bus.publish(GENERAL_TOPIC, job.job_id, {"type": "progress", "data": job.processing.dict()})
+                else:
+                    self.bus.publish(GENERAL_TOPIC, job.job_id, {"type": "queued", "data": job.pending.dict()})
             return
+        self.logger.info(f"Added recording {pending_recording.recording_id} from {pending_recording.submitter} with priority {pending_recording.priority}.")
+        self.bus.publish(GENERAL_TOPIC, job.job_id, {"type": "queued", "data": pending_recording.dict()})
 
-        recording = self.queue.popleft()
-        abort_signal = threading.Event()
-
-        task = asyncio.get_event_loop().run_in_executor(
-            queue_thread, self.perform_task, recording, abort_signal
-        )
-
-        self.current_processing = ProcessingRecording(recording_id=recording.recording_id, type=recording.type, task=task, abort_signal=abort_signal)
-        self.update_general_observers()
-
-    def perform_task(self, recording: PendingRecording, abort_signal: threading.Event):
-        def update_recording_observers(progress: float, status: str):
-            self.current_processing.progress = progress
-            self.current_processing.status = status
-            self.update_general_observers()
-
-            if recording.recording_id in self.recording_observers:
-                recording_observer = self.recording_observers[recording.recording_id]
-                self.send_message_to_client(recording_observer, {"type": "progress", "data": self.current_processing.dict()})
-
-        try:
-            print(f"Processing recording {recording.recording_id}")
-            match recording.type:
-                case "med":
-                    path = self.classifier.med_recording(recording.recording_id, abort_signal=abort_signal, send_update_to_client=update_recording_observers)
-                    update_recording_observers(100, "completed, path: " + path)
-                case "msc":
-                    print("Not implemented yet")
-
-            print("task completed")
-            self.current_processing = None
-            self.update_general_observers()
-            self.process()
-
-        except UserCancelledError:
-            print("cancelled")
-            update_recording_observers(100, "cancelled")
-        except Exception as e:
-            print(f"Error processing recording: {str(e)}")
-            update_recording_observers(100, f"error: {str(e)}")
-        finally:
-            self.current_processing = None
-            self.update_general_observers()
-            self.process()
+    def job_done(self, job: RecordingJob):
+        self.bus.publish(GENERAL_TOPIC, job.job_id, {"type": "removed", "data": job.processing.dict()})
 
-    def watch(self, client: WebSocket):
-        self.general_observers.append(client)
-        self.update_general_observers()
-        print(f"Added general observer. Total observers: {len(self.general_observers)}")
+    def publish_progress(self, job: RecordingJob, final: bool = False):
+        message = {"type": "progress", "data": job.processing.dict()}
+        self.bus.publish_progress(GENERAL_TOPIC, job.job_id, message, final)
+        self.bus.publish_progress(recording_topic(job.pending.recording_id), job.job_id, message, final)
 
+    def watch(self, client: WebSocket):
+        snapshot = {
+            "processing": [job.processing.dict() for job in self.scheduler.active_jobs()],
+            "queue": [job.pending.dict() for job in self.scheduler.waiting_jobs()],
+        }
+        self.bus.subscribe(GENERAL_TOPIC, client, {"snapshot": {"type": "snapshot", "data": snapshot}})
 
     def watch_recording(self, recording_id: str, client: WebSocket):
-        self.recording_observers[recording_id] = client
-
-        if self.current_processing is not None and self.current_processing.recording_id == recording_id:
-            self.send_message_to_client(client, {"type": "progress", "data": self.current_processing.dict()})
+        current = {
+            job.job_id: {"type": "progress", "data": job.processing.dict()}
+            for job in self.scheduler.active_jobs() if job.pending.recording_id == recording_id
+        }
+        self.bus.subscribe(recording_topic(recording_id), client, current)
 
     def cancel(self, recording_id: str):
-        if self.current_processing.recording_id == recording_id:
-            self.current_processing.cancel()
-            self.current_processing = None
-
-        for b in self.queue:
-            if b.recording_id == recording_id:
-                self.queue.remove(b)
-                break
+        for type in ("med", "msc"):
+            self.scheduler.cancel(f"{type}/{recording_id}")
 
     def remove_general_observer(self, client: WebSocket):
-        self.general_observers.remove(client)
-
-    def remove_recording_observer(self, recording_id: str):
-        if recording_id in self.recording_observers:
-            del self.recording_observers[recording_id]
-
-    def update_general_observers(self):
-        # print(f"Updating general observers. Current processing: {self.current_processing.recording_id if self.current_processing is not None else None}, queue size: {len(self.queue)}")
-        for client in self.general_observers:
-            message = {
-                "processing": self.current_processing.dict() if self.current_processing is not None else None,
-                "queue": [recording.dict() for recording in self.queue],
-            }
-            print(f"Sending: {message}")
-            self.send_message_to_client(client, message)
-
-    def send_message_to_client(self, client: WebSocket, message: dict):
-        try:
-            asyncio.run_coroutine_threadsafe(client.send_json(message), self.loop)
-        except RuntimeError:
-            # Handle the case where the WebSocket is closed
-            print(f"Failed to send message to client. WebSocket might be closed.")
+        self.bus.unsubscribe(GENERAL_TOPIC, client)
+
+    def remove_recording_observer(self, recording_id: str, client: WebSocket):
+        self.bus.unsubscribe(recording_topic(recording_id), client)
@@ -1,37 +1,47 @@
 import asyncio
 import threading
-from asyncio import Future
 from collections import deque
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from lib.exceptions import UserCancelledError
 
 
+# Interactive requests get a larger share of the pipeline workers than bulk backfills.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+PRIORITY_WEIGHTS = {PRIORITY_INTERACTIVE: 4.0, PRIORITY_BULK: 1.0}
+
 class PendingRecording:
-    def __init__(self, recording_id: str, type: str):
+    # submitter: who asked for the recording, the workers are shared fairly between submitters.
+    def __init__(self, recording_id: str, type: str, priority: int = PRIORITY_INTERACTIVE, submitter: str = "default"):
         self.recording_id = recording_id
         self.type = type
+        self.priority = priority
+        self.submitter = submitter
     
     @staticmethod
-    def med(recording_id: str):
-        return PendingRecording(recording_id, "med")  
+    def med(recording_id: str, priority: int = PRIORITY_INTERACTIVE, submitter: str = "default"):
+        return PendingRecording(recording_id, "med", priority, submitter)  
     
     @staticmethod
-    def msc(recording_id: str): 
-        return PendingRecording(recording_id, "msc")
+    def msc(recording_id: str, priority: int = PRIORITY_INTERACTIVE, submitter: str = "default"): 
+        return PendingRecording(recording_id, "msc", priority, submitter)
 
     def __str__(self):
-        return f"RecordingToBeProcessed(recording_id={self.recording_id}, type={self.type})"
+        return f"RecordingToBeProcessed(recording_id={self.recording_id}, type={self.type}, priority={self.priority}, submitter={self.submitter})"
     
     def dict(self):
         return {
             "recording_id": self.recording_id,
-            "type": self.type
+            "type": self.type,
+            "priority": self.priority,
+            "submitter": self.submitter
         }
     
 class ProcessingRecording:
-    def __init__(self, recording_id: str, type: str,task: Future,abort_signal: threading.Event) -> None:
+    def __init__(self, recording_id: str, type: str,task: Future | None,abort_signal: threading.Event, priority: int = PRIORITY_INTERACTIVE) -> None:
         self.recording_id = recording_id
+        self.priority = priority
         self.progress = 0
         self.status = "Not started"
         self.type = type
@@ -42,7 +52,7 @@ class ProcessingRecording:
     def cancel(self):
         print("Cancelling task")    
         self.abort_signal.set()
-        if not self.task.done():
+        if self.task is not None and not self.task.done():
             self.task.cancel()
 
     def update(self, progress: int, status: str):
@@ -54,5 +64,6 @@ class ProcessingRecording:
             "recording_id": self.recording_id,
             "progress": self.progress,
             "status": self.status,
-            "type": self.type
+            "type": self.type,
+            "priority": self.priority
         }
@@ -0,0 +1,98 @@
+import asyncio
+import threading
+import time
+from logging import getLogger
+
+from fastapi import WebSocket
+
+
+class _Subscriber:
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        # Latest unsent message per key, a newer message for the same key replaces the stale one
+        self.pending: dict[str, dict] = {}
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+
+"""
+Delivers progress messages to websocket observers without flooding the event loop.
+   - Messages are published to a topic under a key (e.g. the job id). Every subscriber keeps only the latest
+     unsent message per key, so a slow socket gets the current state instead of a growing backlog.
+   - Each subscriber has its own sender task, one slow client does not hold up the others.
+   - `publish_progress` additionally drops updates of a key that come within `min_interval` seconds of the
+     previous one, unless they are final.
+`publish` and `publish_progress` can be called from any thread; subscribing happens on the event loop.
+`stats()` reports the subscribers and the messages they skipped.
+"""
+class ProgressBus:
+    def __init__(self, loop: asyncio.AbstractEventLoop, min_interval: float = 0.5):
+        self.logger = getLogger(__name__)
+        self.loop = loop
+        self.min_interval = min_interval
+        self.topics: dict[str, list[_Subscriber]] = {}
+        self.last_published: dict[str, float] = {}
+        self.lock = threading.Lock()
+        # Unsent messages replaced by a newer one for the same key, i.e. updates a slow subscriber skipped
+        self.superseded = 0
+
+    # Call on the event loop. `initial` messages are sent first, e.g. a snapshot of the current state.
+    def subscribe(self, topic: str, websocket: WebSocket, initial: dict[str, dict] | None = None):
+        subscriber = _Subscriber(websocket)
+        subscriber.pending.update(initial or {})
+        subscriber.task = self.loop.create_task(self._send(subscriber))
+        self.topics.setdefault(topic, []).append(subscriber)
+        if subscriber.pending:
+            subscriber.wakeup.set()
+
+    def unsubscribe(self, topic: str, websocket: WebSocket):
+        subscribers = self.topics.get(topic, [])
+        for subscriber in [subscriber for subscriber in subscribers if subscriber.websocket is websocket]:
+            subscribers.remove(subscriber)
+            subscriber.task.cancel()
+        if not subscribers:
+            self.topics.pop(topic, None)
+
+    def publish(self, topic: str, key: str, message: dict):
+        self.loop.call_soon_threadsafe(self._enqueue, topic, key, message)
+
+    def publish_progress(self, topic: str, key: str, message: dict, final: bool = False):
+        now = time.monotonic()
+        rate_key = f"{topic}/{key}"
+        with self.lock:
+            if not final and now - self.last_published.get(rate_key, float("-inf")) < self.min_interval:
+                return
+            if final:
+                self.last_published.pop(rate_key, None)
+            else:
+                self.last_published[rate_key] = now
+        self.publish(topic, key, message)
+
+    def _enqueue(self, topic: str, key: str, message: dict):
+        for subscriber in self.topics.get(topic, []):
+            if key in subscriber.pending:
+                self.superseded += 1
+            subscriber.pending[key] = message
+            subscriber.wakeup.set()
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": sum(len(subscribers) for subscribers in self.topics.values()),
+            "pending": sum(len(subscriber.pending) for subscribers in self.topics.values() for subscriber in subscribers),
+            "superseded": self.superseded,
+        }
+
+    async def _send(self, subscriber: _Subscriber):
+        while True:
+            await subscriber.wakeup.wait()
+            subscriber.wakeup.clear()
+            while subscriber.pending:
+                key = next(iter(subscriber.pending))
+                message = subscriber.pending.pop(key)
+                try:
+                    await subscriber.websocket.send_json(message)
+                except Exception as e:
+                    # The socket is closing, its handler unsubscribes it
+                    self.logger.info(f"Failed to send message to client, it might be closed: {e}")
+                    subscriber.pending.clear()
+                    break
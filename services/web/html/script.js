@@ -85,7 +85,7 @@ async function performMed(input) {
   socket.addEventListener('open', async () => {
     window.showBanner('Connection established. Sending file...');
     setIsLoading(true, 'medButton');
-    socket.send(JSON.stringify(Array.from(input)));
+    socket.send(encodeAudioFrame(input));
     showToast('File sent. Waiting for response...');
   });
 
@@ -121,7 +121,7 @@ async function performMsc(input) {
   socket.addEventListener('open', () => {
     showToast('WebSocket connection established. Sending file...');
     setIsLoading(true, 'mscButton');
-    socket.send(JSON.stringify(Array.from(input)));
+    socket.send(encodeAudioFrame(input));
   });
 
   // Handle messages received from the server
@@ -50,6 +50,28 @@ async function getProcessedDataFromFile(file) {
 
 window.getProcessedDataFromFile = getProcessedDataFromFile;
 
+/**
+ * Wraps float32 samples in the binary audio frame understood by the /med and /msc websockets:
+ * a 12 byte little-endian header (magic "HBAF", encoding, channels, flags, sample rate) followed by the raw samples.
+ *
+ * @param {Float32Array} samples - Mono samples.
+ * @param {number} sampleRate - Sample rate of the samples in Hz.
+ * @returns {Blob}
+ */
+function encodeAudioFrame(samples, sampleRate = 8000) {
+  const header = new DataView(new ArrayBuffer(12));
+  'HBAF'.split('').forEach((character, index) => header.setUint8(index, character.charCodeAt(0)));
+  header.setUint8(4, 1); // float32
+  header.setUint8(5, 1); // mono
+  header.setUint16(6, 0, true);
+  header.setUint32(8, sampleRate, true);
+
+  // Float32Array uses the platform byte order, which is little-endian on every browser platform
+  return new Blob([header.buffer, samples]);
+}
+
+window.encodeAudioFrame = encodeAudioFrame;
+
 const batchSize = 15360;
 
 const medButtonId = 'medButton';
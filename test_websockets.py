@@ -7,6 +7,7 @@ from pathlib import Path
 import librosa
 import websockets
 
+from services.live.audio_frames import encode_frame
 from testing.graphs import plot_predictions, plot_species_predictions
 
 # Configure logging
@@ -37,7 +38,7 @@ async def connect_and_test():
             signal, _ = librosa.load(file_path,sr= 8000)
                 
             logger.info(f"Sending file: {file_path.name}")
-            await websocket.send(json.dumps(signal.tolist()))
+            await websocket.send(encode_frame(signal, sample_rate=8000))
             
             # Listen for responses until the connection is closed
             has_closed = False
@@ -0,0 +1,32 @@
+import time
+
+import torch
+
+from lib.med.mids_med import MidsMEDModel
+from lib.msc.mids_msc import MidsMSCModel
+
+REPEATS = 20
+
+# Times the post-PCEN chain (normalize, Resize, zero check) against the fused frontend.
+# Only the frontend is timed, so freshly initialised models are enough.
+def benchmark(name, model, shape):
+    model.eval()
+    model.prepare_for_inference()
+    spec = torch.rand(shape)
+    with torch.no_grad():
+        for label, chain in (("current", model.resize_for_backbone), ("fused", model.fused_frontend)):
+            chain(spec.clone())
+            start = time.perf_counter()
+            for _ in range(REPEATS):
+                chain(spec.clone())
+            elapsed = (time.perf_counter() - start) / REPEATS * 1000
+            print(f"{name} batch {shape[0]:>3} {label:>8}: {elapsed:.2f} ms")
+
+        current, _ = model.resize_for_backbone(spec.clone())
+        fused, _ = model.fused_frontend(spec.clone())
+        print(f"{name} batch {shape[0]:>3} max difference: {(current - fused).abs().max().item():.2e}")
+
+
+for batch_size in (1, 16):
+    benchmark("MED", MidsMEDModel(), (batch_size, 513, 121))
+    benchmark("MSC", MidsMSCModel(), (batch_size, 1025, 31))
@@ -0,0 +1,15 @@
+import json
+
+from lib.med.event_detector import EventDetector
+from lib.msc.species_classifier import SpeciesClassifier
+
+MED_MODEL_PATH = "lib/med/model_presentation_draft_2022_04_07_11_52_08.pth"
+MSC_MODEL_PATH = "lib/msc/model_e186_2022_10_11_11_18_50.pth"
+
+# Prints which STFT path (fft or conv) each checkpoint ends up using, with the measured deviations.
+reports = {
+    MED_MODEL_PATH: EventDetector(MED_MODEL_PATH).frontend_report,
+    MSC_MODEL_PATH: SpeciesClassifier(MSC_MODEL_PATH).frontend_report,
+}
+
+print(json.dumps(reports, indent=4))
@@ -0,0 +1,62 @@
+import asyncio
+import json
+import sys
+import time
+
+import librosa
+import numpy as np
+import websockets
+from urllib.request import urlopen
+
+from services.live.audio_frames import encode_frame
+
+# Saturates the live service with concurrent /med requests and measures /health latency meanwhile.
+# With inference on the event loop /health stalls for a whole request, with the inference executor it stays in milliseconds.
+# Usage: python testing/health_latency_test.py [host:port] [concurrent clients]
+HOST = sys.argv[1] if len(sys.argv) > 1 else "localhost:8002"
+CLIENTS = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+RECORDING_PATH = "lib/storage/test_audio_on_off.wav"
+
+
+async def classify(frame: bytes) -> float:
+    start = time.perf_counter()
+    async with websockets.connect(f"ws://{HOST}/med", max_size=None) as websocket:
+        await websocket.send(frame)
+        while json.loads(await websocket.recv())["type"] not in ("complete", "error"):
+            pass
+    return time.perf_counter() - start
+
+
+def get_health() -> float:
+    start = time.perf_counter()
+    with urlopen(f"http://{HOST}/health") as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+async def poll_health(done: asyncio.Event) -> list[float]:
+    latencies = []
+    while not done.is_set():
+        # urlopen blocks, keep it off this loop so the websocket clients keep running
+        latencies.append(await asyncio.to_thread(get_health))
+        await asyncio.sleep(0.05)
+    return latencies
+
+
+async def main():
+    signal, _ = librosa.load(RECORDING_PATH, sr=8000)
+    frame = encode_frame(signal, sample_rate=8000)
+
+    print(f"Idle /health: {get_health() * 1000:.1f} ms")
+    done = asyncio.Event()
+    health = asyncio.create_task(poll_health(done))
+    durations = await asyncio.gather(*[classify(frame) for _ in range(CLIENTS)])
+    done.set()
+    latencies = np.array(await health) * 1000
+
+    print(f"{CLIENTS} concurrent /med requests took {min(durations):.2f} - {max(durations):.2f} s")
+    print(f"/health under load ({len(latencies)} calls): p50 {np.percentile(latencies, 50):.1f} ms, p99 {np.percentile(latencies, 99):.1f} ms, max {latencies.max():.1f} ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
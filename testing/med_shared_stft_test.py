@@ -0,0 +1,53 @@
+import sys
+
+import librosa
+import numpy as np
+import torch
+
+from lib.config import Config
+from lib.med.event_detector import (SHARED_STFT_TOLERANCE, EventDetector,
+                                    shared_stft_check_path,
+                                    write_shared_stft_check)
+
+MODEL_PATH = sys.argv[1] if len(sys.argv) > 1 else "lib/med/model_presentation_draft_2022_04_07_11_52_08.pth"
+RECORDING_PATHS = ["lib/storage/test_audio_on_off.wav", "lib/storage/test_no_presence.wav", "lib/storage/anoph_arabien.wav", "lib/storage/record.wav"]
+
+# Compares per-window detection with the shared STFT detection mode on the pipeline windows.
+# Fails when the probabilities differ by more than SHARED_STFT_TOLERANCE or the events differ on any recording;
+# on success records the check next to the checkpoint, MED_SHARED_STFT only uses the shared STFT for
+# checkpoints with such a record.
+config = Config.default()
+window_length = config.single_batch_length()
+step_length = config.step_size * config.n_hop
+
+detector = EventDetector(MODEL_PATH, batch_size=16)
+no_progress = lambda progress, message: None
+
+max_difference = 0.0
+different_events = []
+for recording_path in RECORDING_PATHS:
+    signal, _ = librosa.load(recording_path, sr=8000)
+    signal = torch.FloatTensor(signal)
+    windows = signal.unsqueeze(0).unfold(1, window_length, step_length).transpose(0, 1)
+
+    per_window = detector.detect(windows, no_progress)
+    shared = detector.detect_signal(signal, window_length, step_length, no_progress)
+
+    difference = np.abs(per_window.predictions_array - shared.predictions_array).max(initial=0.0)
+    max_difference = max(max_difference, difference)
+    print(f"{recording_path}: {len(per_window.predictions_array)} windows, max probability difference: {difference:.6f}")
+    per_window_events, shared_events = per_window.get_data_frame(config), shared.get_data_frame(config)
+    print("Per window events:\n", per_window_events)
+    print("Shared STFT events:\n", shared_events)
+    boundaries = [[(row["med_start_time"], row["med_stop_time"]) for _, row in events.iterrows()] for events in (per_window_events, shared_events)]
+    if boundaries[0] != boundaries[1]:
+        different_events.append(recording_path)
+
+if max_difference > SHARED_STFT_TOLERANCE:
+    print(f"FAILED: max probability difference {max_difference:.6f} is above the tolerance {SHARED_STFT_TOLERANCE}")
+    sys.exit(1)
+if different_events:
+    print(f"FAILED: the events differ on {', '.join(different_events)}")
+    sys.exit(1)
+write_shared_stft_check(MODEL_PATH, float(max_difference))
+print(f"Passed: max probability difference {max_difference:.6f} within {SHARED_STFT_TOLERANCE} and identical events, recorded in {shared_stft_check_path(MODEL_PATH)}")